@@ -0,0 +1,74 @@
+"""
+Import-time benchmark for huji_lab.
+Measures the cost of "import huji_lab" (and of the light batch path: Errors.chi_squared, DataProc.fit_sin)
+in fresh interpreters, and fails if heavy dependencies are loaded eagerly or the time exceeds the budget.
+Usage: python benchmarks/bench_import.py [--repeat 5] [--budget 0.5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must not be imported by "import huji_lab" alone.
+HEAVY_MODULES = ('pandas', 'matplotlib', 'seaborn', 'scipy', 'sympy', 'mplcursors',
+                 'wolframalpha', 'IPython', 'uncertainties')
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import huji_lab
+{access}
+elapsed = time.perf_counter() - start
+loaded = sorted(set(m.split('.')[0] for m in sys.modules))
+print(json.dumps({{'seconds': elapsed, 'modules': loaded}}))
+"""
+
+SCENARIOS = {
+    'import': '',
+    'batch_path': 'huji_lab.Errors.chi_squared, huji_lab.DataProc.fit_sin',
+}
+
+
+def measure(access, repeat):
+    """
+    Runs the probe in fresh interpreters.
+    :param access: Python code to run right after "import huji_lab".
+    :param repeat: Number of fresh interpreters to sample.
+    :return: A tuple of (best time in seconds, list of top-level modules loaded).
+    """
+    best = None
+    modules = []
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', _PROBE.format(access=access)], env=env)
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or res['seconds'] < best:
+            best = res['seconds']
+        modules = res['modules']
+    return best, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per scenario.')
+    parser.add_argument('--budget', type=float, default=0.5, help='Max seconds allowed per scenario.')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for name, access in SCENARIOS.items():
+        seconds, modules = measure(access, args.repeat)
+        heavy = [m for m in HEAVY_MODULES if m in modules]
+        status = 'ok'
+        if heavy or seconds > args.budget:
+            status = 'FAIL'
+            failed = True
+        print("%-12s %8.1f ms  %-4s %s" % (name, seconds * 1e3, status,
+                                          ('eagerly loaded: ' + ', '.join(heavy)) if heavy else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,496 @@
+"""
+Benchmark suite for huji_lab: wall time, peak memory (tracemalloc) and import cost of the public functions,
+on synthetic data of several sizes. Runs offline, plots go to the Agg backend.
+Not timed: the DataProc.wolfram_* queries (network), Display.print_* (notebook output only) and the Profiling
+helpers (their overhead is part of every instrumented case). Errors.Propagation, Errors.iter_n_sigma_pairs,
+Loaders.load_columns, Cache.make_key and Reports.spec_hash are timed through the cases that call them.
+
+Usage:
+    python benchmarks/bench_suite.py                       # run, print a table
+    python benchmarks/bench_suite.py --sizes 100 10000000  # custom sizes (each case has its own max size)
+    python benchmarks/bench_suite.py --save-baseline       # store results in benchmarks/baseline.json
+    python benchmarks/bench_suite.py --compare             # compare against the baseline, exit 1 on regression
+"""
+import argparse
+import atexit
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import matplotlib  # noqa: E402
+matplotlib.use('Agg')
+import numpy as np  # noqa: E402
+
+import datagen  # noqa: E402
+import bench_import  # noqa: E402
+
+DEFAULT_SIZES = (100, 10000, 1000000)
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+MODULES = ('Errors', 'DataProc', 'Fitting', 'Generators', 'Graph', 'Display', 'Profiling', 'Cache', 'Reports',
+           'Loaders', 'Bootstrap')
+
+# Scratch directory for file backed cases, removed at exit.
+_scratch = tempfile.TemporaryDirectory(prefix='huji_lab_bench_')
+atexit.register(_scratch.cleanup)
+
+LINE = lambda x, a, b: a * x + b  # noqa: E731
+POWER = lambda x, a, b: a * x ** b  # noqa: E731
+
+
+def _close_figures(func):
+    def run():
+        import matplotlib.pyplot as plt
+        res = func()
+        plt.close('all')
+        return res
+    return run
+
+
+def _graph_it(n):
+    from huji_lab import Graph
+    x, y, err = datagen.noisy_line(n)
+    return _close_figures(lambda: Graph.graph_it(x, y, LINE, y_error=err, max_points=5000 if n > 5000 else None))
+
+
+def _dynamic_draw(n):
+    from huji_lab import Graph
+    x, y, _ = datagen.noisy_line(n)
+    path = _csv_file('line', x, y)
+    quiet = _close_figures(lambda: Graph.dynamic_draw(path, refresh_time=0, max_updates=1))
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):  # display() prints the figure outside a notebook
+            return quiet()
+    return run
+
+
+def _export_graphs(n, force=True):
+    from huji_lab import Reports
+    specs = [dict(zip(('x', 'y', 'y_error'), datagen.noisy_line(n, seed=i)), name='run%d' % i, graph_type=LINE,
+                  max_points=5000 if n > 5000 else None) for i in range(4)]
+    directory = tempfile.mkdtemp(dir=_scratch.name)
+    if not force:
+        Reports.export_graphs(specs, directory, processes=1)
+    return lambda: Reports.export_graphs(specs, directory, processes=1, force=force)
+
+
+def _export_graphs_cached(n):
+    return _export_graphs(n, force=False)
+
+
+def _csv_file(name, x, y):
+    path = os.path.join(_scratch.name, '%s_%d.csv' % (name, len(x)))
+    if not os.path.exists(path):
+        np.savetxt(path, np.column_stack((x, y)), delimiter=',', header='x,y', comments='')
+    return path
+
+
+def _load_array(n):
+    from huji_lab import Loaders
+    x, y = datagen.peaky_waveform(n)
+    path = os.path.join(_scratch.name, 'array_%d.npy' % n)
+    np.save(path, np.column_stack((x, y)))
+    return lambda: Loaders.load_array(path).sum(axis=0)
+
+
+def _iter_csv(n):
+    from huji_lab import Loaders
+    x, y = datagen.peaky_waveform(n)
+    path = _csv_file('waveform', x, y)
+    return lambda: sum(len(chunk[0]) for chunk in Loaders.iter_csv(path, chunk_rows=max(n // 10, 1)))
+
+
+def _csv_to_npy(n):
+    from huji_lab import Loaders
+    x, y = datagen.peaky_waveform(n)
+    path = _csv_file('waveform', x, y)
+    return lambda: Loaders.csv_to_npy(path, os.path.join(_scratch.name, 'converted_%d.npy' % n),
+                                      chunk_rows=max(n // 10, 1))
+
+
+def _iter_chunks(n):
+    from huji_lab import Loaders
+    x, y = datagen.peaky_waveform(n)
+    return lambda: sum(chunk[1].sum() for chunk in Loaders.iter_chunks(x, y, chunk_rows=max(n // 10, 1)))
+
+
+def _disk_cache(n):
+    from huji_lab import Cache
+    blobs = [np.random.RandomState(i).bytes(100) for i in range(min(n, 1000))]
+
+    def run():
+        cache = Cache.DiskCache(tempfile.mkdtemp(dir=_scratch.name))
+        keys = [Cache.make_key('bench', i) for i in range(len(blobs))]
+        for key, blob in zip(keys, blobs):
+            cache.put(key, blob)
+        return [cache.get(key) for key in keys]
+    return run
+
+
+def _chi_squared(n):
+    from huji_lab import Errors
+    x, y, err = datagen.noisy_line(n)
+    return lambda: Errors.chi_squared(x, y, [2., 1.], err, LINE)
+
+
+def _fit_it_linear(n):
+    from huji_lab import Fitting
+    x, y, err = datagen.noisy_line(n)
+    return lambda: Fitting.fit_it(x, y, LINE, err)
+
+
+def _fit_it_power(n):
+    from huji_lab import Fitting
+    x, _, err = datagen.noisy_line(n)
+    x = x + 1.
+    y = 3. * x ** 1.5 + np.random.RandomState(0).normal(0., err)
+    return lambda: Fitting.fit_it(x, y, POWER, err, p0=[1., 1.], jac='auto')
+
+
+def _linear_basis(n):
+    from huji_lab import Fitting
+    x, _, _ = datagen.noisy_line(n)
+    return lambda: Fitting.linear_basis(POWER, x + 1.)
+
+
+def _derive_jacobian(n):
+    from huji_lab import Fitting
+    # derive_jacobian caches per function, so each run gets a new one.
+    return lambda: Fitting.derive_jacobian(lambda x, a, b, c: a * x ** b + c / x)
+
+
+def _fit_many(n):
+    from huji_lab import Fitting
+    datasets = [datagen.noisy_line(100, seed=i) for i in range(n // 100)]
+    return lambda: Fitting.fit_many(datasets, LINE, processes=1)
+
+
+def _bootstrap_fit(n):
+    from huji_lab import Bootstrap
+    x, y, err = datagen.noisy_line(n)
+    return lambda: Bootstrap.bootstrap_fit(x, y, LINE, err, n_resamples=200, seed=0)
+
+
+def _fit_sin(n):
+    from huji_lab import DataProc
+    t, y = datagen.noisy_sine(n)
+    return lambda: DataProc.fit_sin(t, y[0])
+
+
+def _fit_sin_many(n):
+    from huji_lab import DataProc
+    t, y = datagen.noisy_sine(n // 8, channels=8)
+    return lambda: DataProc.fit_sin_many(t, y, processes=1)
+
+
+def _detect_maxima(n):
+    from huji_lab import DataProc
+    x, y = datagen.peaky_waveform(n)
+    return lambda: DataProc.detect_maxima(x, y, sensitivity=50)
+
+
+def _detect_minima(n):
+    from huji_lab import DataProc
+    x, y = datagen.peaky_waveform(n)
+    return lambda: DataProc.detect_minima(x, -y, sensitivity=50)
+
+
+def _detect_extrema(n):
+    from huji_lab import DataProc
+    x, y = datagen.peaky_waveform(n)
+    return lambda: DataProc.detect_extrema(x, y, sensitivity=50)
+
+
+def _detect_extrema_stream(n):
+    from huji_lab import DataProc
+    x, y = datagen.peaky_waveform(n)
+    step = max(n // 10, 1)
+    return lambda: list(DataProc.detect_extrema_stream(((x[i:i + step], y[i:i + step])
+                                                        for i in range(0, n, step)), sensitivity=50))
+
+
+def _detect_extrema_memmap(n):
+    from huji_lab import DataProc, Loaders
+    x, y = datagen.peaky_waveform(n)
+    path = os.path.join(_scratch.name, 'waveform_%d.npy' % n)
+    np.save(path, np.column_stack((x, y)))
+    x, y = Loaders.load_columns(path)
+    return lambda: DataProc.detect_extrema(x, y, sensitivity=50)
+
+
+def _decimate(n):
+    from huji_lab import DataProc
+    x, y = datagen.peaky_waveform(n)
+    return lambda: DataProc.decimate(x, y, 5000)
+
+
+def _freq_over_time(n):
+    from huji_lab import DataProc
+    times = np.cumsum(np.random.RandomState(0).uniform(0.5, 1.5, n))
+    return lambda: DataProc.freq_over_time_calculator(times)
+
+
+def _event_rate(n):
+    from huji_lab import DataProc
+    times = np.cumsum(np.random.RandomState(0).uniform(0.5, 1.5, n))
+    batches = np.array_split(times, 10)
+
+    def run():
+        estimator = DataProc.EventRateEstimator(window=100.)
+        for batch in batches:
+            estimator.add(batch)
+        return estimator.window_rate(), estimator.ewma_rate()
+    return run
+
+
+def _partial_derivatives(n):
+    from huji_lab import Errors
+    params = ['m%d' % i for i in range(min(n, 20))]
+    equation = ' + '.join('%s**2' % par for par in params)
+    return lambda: Errors.partial_derivatives(equation, params)
+
+
+def _error_propagation(n):
+    from huji_lab import Errors
+    nominals, deviations, _ = datagen.ufloat_table(n)
+    prop = Errors.error_propagation('m*r**2 + 2*m*R**2', ['m', 'r', 'R'])
+    return lambda: prop.propagate([nominals, nominals, nominals], [deviations, deviations, deviations])
+
+
+def _results_sum(n):
+    from huji_lab import Errors
+    values = datagen.ufloats(n)
+    return lambda: Errors.results_sum_with_deviation(values)
+
+
+def _weighted_mean(n):
+    from huji_lab import Errors
+    nominals, deviations, groups = datagen.ufloat_table(n)
+    return lambda: Errors.weighted_mean(nominals, deviations, groups, consistency=True)
+
+
+def _weighted_mean_frame(n):
+    import pandas as pd
+    from huji_lab import Errors
+    nominals, deviations, groups = datagen.ufloat_table(n)
+    frame = pd.DataFrame({'value': nominals, 'error': deviations, 'group': groups})
+    return lambda: Errors.weighted_mean_frame(frame, 'value', 'error', by='group', consistency=True)
+
+
+def _measurements_deviation_array(n):
+    from huji_lab import Errors
+    nominals, _, _ = datagen.ufloat_table(n)
+    return lambda: Errors.measurements_deviation(nominals.reshape(-1, min(n, 100)))
+
+
+def _measurements_deviation(n):
+    from huji_lab import Errors
+    nominals, _, _ = datagen.ufloat_table(n)
+    return lambda: Errors.measurements_deviation_calculator(nominals)
+
+
+def _accumulator(n):
+    from huji_lab import Errors
+    nominals, _, _ = datagen.ufloat_table(n)
+    step = max(n // 100, 1)
+    return lambda: Errors.MeasurementAccumulator().add(nominals[:step]).merge(
+        Errors.MeasurementAccumulator().add(nominals[step:])).ufloat()
+
+
+def _n_sigma(n):
+    from huji_lab import Errors
+    return lambda: [Errors.n_sigma_test(1., 0.1, 1.2, 0.1) for _ in range(n)]
+
+
+def _n_sigma_matrix(n):
+    from huji_lab import Errors
+    nominals, deviations, _ = datagen.ufloat_table(n)
+    # n x 100, so the size grows linearly with n.
+    return lambda: Errors.n_sigma_matrix(nominals, deviations, nominals[:100], deviations[:100])
+
+
+def _n_sigma_pairs(n):
+    from huji_lab import Errors
+    deviations = np.random.RandomState(0).uniform(0.2, 1., n)
+    values = np.random.RandomState(1).normal(0., deviations)
+    return lambda: Errors.n_sigma_pairs(values, deviations, threshold=5.)
+
+
+def _expand_linspace(n):
+    from huji_lab import Generators
+    return lambda: Generators.expand_linspace(-1., 1., n)
+
+
+def _generate_pi_axis(n):
+    from huji_lab import Generators
+    return lambda: Generators.generate_pi_axis(jumps=min(n, 1000))
+
+
+# name: (setup(n) -> function to time, max size)
+CASES = {
+    'Graph.graph_it': (_graph_it, 10 ** 6),
+    'Graph.dynamic_draw[csv]': (_dynamic_draw, 10 ** 6),
+    'Reports.export_graphs': (_export_graphs, 10 ** 5),
+    'Reports.export_graphs[cached]': (_export_graphs_cached, 10 ** 5),
+    'Loaders.load_array': (_load_array, 10 ** 7),
+    'Loaders.iter_chunks': (_iter_chunks, 10 ** 7),
+    'Loaders.iter_csv': (_iter_csv, 10 ** 6),
+    'Loaders.csv_to_npy': (_csv_to_npy, 10 ** 6),
+    'Cache.DiskCache': (_disk_cache, 1000),
+    'Errors.chi_squared': (_chi_squared, 10 ** 7),
+    'Fitting.fit_it[linear]': (_fit_it_linear, 10 ** 7),
+    'Fitting.fit_it[power,jac]': (_fit_it_power, 10 ** 6),
+    'Fitting.linear_basis': (_linear_basis, 10 ** 7),
+    'Fitting.derive_jacobian': (_derive_jacobian, 100),
+    'Fitting.fit_many': (_fit_many, 10 ** 6),
+    'Bootstrap.bootstrap_fit[linear]': (_bootstrap_fit, 10 ** 5),
+    'DataProc.fit_sin': (_fit_sin, 10 ** 6),
+    'DataProc.fit_sin_many': (_fit_sin_many, 10 ** 7),
+    'DataProc.detect_maxima': (_detect_maxima, 10 ** 7),
+    'DataProc.detect_minima': (_detect_minima, 10 ** 7),
+    'DataProc.detect_extrema': (_detect_extrema, 10 ** 7),
+    'DataProc.detect_extrema_stream': (_detect_extrema_stream, 10 ** 7),
+    'DataProc.detect_extrema[memmap]': (_detect_extrema_memmap, 10 ** 7),
+    'DataProc.decimate': (_decimate, 10 ** 7),
+    'DataProc.freq_over_time_calculator': (_freq_over_time, 10 ** 6),
+    'DataProc.EventRateEstimator': (_event_rate, 10 ** 7),
+    'Errors.partial_derivatives': (_partial_derivatives, 100),
+    'Errors.error_propagation': (_error_propagation, 10 ** 7),
+    'Errors.results_sum_with_deviation': (_results_sum, 10 ** 5),
+    'Errors.weighted_mean': (_weighted_mean, 10 ** 7),
+    'Errors.weighted_mean_frame': (_weighted_mean_frame, 10 ** 7),
+    'Errors.measurements_deviation_calculator': (_measurements_deviation, 10 ** 7),
+    'Errors.measurements_deviation': (_measurements_deviation_array, 10 ** 7),
+    'Errors.MeasurementAccumulator': (_accumulator, 10 ** 7),
+    'Errors.n_sigma_test': (_n_sigma, 10 ** 5),
+    'Errors.n_sigma_matrix': (_n_sigma_matrix, 10 ** 5),
+    'Errors.n_sigma_pairs': (_n_sigma_pairs, 10 ** 4),
+    'Generators.expand_linspace': (_expand_linspace, 10 ** 7),
+    'Generators.generate_pi_axis': (_generate_pi_axis, 1000),
+}
+
+
+def time_call(func, repeat, budget):
+    """
+    :return: Best wall time in seconds, over up to "repeat" runs (stops early once "budget" seconds are spent).
+    """
+    best = None
+    spent = 0.
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        if spent > budget:
+            break
+    return best
+
+
+def peak_memory(func):
+    """
+    :return: Peak memory (bytes) allocated during one call, as traced by tracemalloc (includes numpy buffers).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(cases, sizes, repeat, budget):
+    results = {}
+    for name in cases:
+        setup, max_size = CASES[name]
+        for size in sizes:
+            if size > max_size:
+                continue
+            func = setup(size)
+            func()  # warm up: lazy imports, caches
+            key = '%s@%d' % (name, size)
+            results[key] = {'seconds': time_call(func, repeat, budget), 'peak_bytes': peak_memory(func)}
+            print("%-50s %12.3f ms %10.1f MB" % (key, results[key]['seconds'] * 1e3,
+                                                results[key]['peak_bytes'] / 2. ** 20))
+            sys.stdout.flush()
+    for module in MODULES:
+        seconds, _ = bench_import.measure('import huji_lab.%s' % module, repeat=3)
+        key = 'import huji_lab.%s' % module
+        results[key] = {'seconds': seconds}
+        print("%-50s %12.3f ms" % (key, seconds * 1e3))
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Flags results slower (or using more memory) than the baseline by more than "tolerance" (relative).
+    Timings under "min_seconds" in both runs are too noisy to judge and are skipped.
+    Results with no baseline entry can't be checked, and are reported too (regenerate with --save-baseline).
+    :return: A list of regression descriptions.
+    """
+    regressions = []
+    for key, res in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            regressions.append("%s: missing from the baseline" % key)
+            continue
+        if max(res['seconds'], base['seconds']) >= min_seconds and res['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append("%s: time %.3f ms -> %.3f ms" % (key, base['seconds'] * 1e3, res['seconds'] * 1e3))
+        if 'peak_bytes' in res and 'peak_bytes' in base and \
+                res['peak_bytes'] > base['peak_bytes'] * (1 + tolerance) + 2 ** 16:
+            regressions.append("%s: peak memory %.1f MB -> %.1f MB" % (key, base['peak_bytes'] / 2. ** 20,
+                                                                      res['peak_bytes'] / 2. ** 20))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Data sizes (10^2 to 10^7).')
+    parser.add_argument('--only', nargs='+', default=None, help='Run only cases whose name contains these.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per case (the best is kept).')
+    parser.add_argument('--budget', type=float, default=2., help='Max seconds of timing runs per case.')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline json file.')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline.')
+    parser.add_argument('--compare', action='store_true', help='Compare with the baseline, exit 1 on regression.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown.')
+    parser.add_argument('--min-seconds', type=float, default=1e-3, help='Ignore timings below this.')
+    parser.add_argument('--json', default=None, help='Also write the results to this json file.')
+    args = parser.parse_args(argv)
+
+    cases = [name for name in CASES if args.only is None or any(part in name for part in args.only)]
+    results = run(cases, args.sizes, args.repeat, args.budget)
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(report, fh, indent=1, sort_keys=True)
+        print("Baseline written to %s" % args.baseline)
+    if args.compare:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        for line in regressions:
+            print("REGRESSION " + line)
+        print("%d regression(s) against %s" % (len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
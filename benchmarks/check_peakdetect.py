@@ -0,0 +1,73 @@
+"""
+Regression check for DataProc.detect_extrema / detect_extrema_stream.
+The expected peaks are those of analytic_wfm.peakdetect (delta=0), which is no longer a dependency: hand-worked
+signals covering the first-hit drop, ties (reported at their first occurrence since the last peak) and peaks
+straddling chunk boundaries. Every chunk size of the streaming detector must give the same peaks.
+Usage: python benchmarks/check_peakdetect.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+# name: (y, lookahead, expected maxima indices, expected minima indices). x is 0.5 * index.
+CASES = {
+    # The first hit is a minimum at index 0 (index 1 has no lower point within the lookahead), and it is dropped.
+    # Finding it resets the running maximum, so the 3 at index 1 is never a maximum.
+    'first_hit': ([0, 3, 1, 0, 1, 4, 2, 1, 0, 2, 5, 1, 0, 0, 0], 2, [5, 10], [8]),
+    # After the (dropped) minimum at 0, the search restarts at index 2: the tie 2, 2 is reported at index 2,
+    # the plateau 3, 3, 3 at its first point.
+    'ties': ([0, 2, 2, 1, 0, 0, 1, 3, 3, 3, 1, 0, 0, 0, 0], 2, [2, 7], [4]),
+    # The first hit is the maximum 5 at index 0 (dropped), which resets the running minimum, so the 1 at index 1
+    # is skipped. The flat minimum 1, 1 is reported at its first point. The plateau of 2s at the end holds no peak.
+    'plateau': ([5, 1, 4, 1, 1, 2, 6, 2, 2, 2, 2, 2], 1, [6], [3]),
+    # Triangle waves, peaks several chunks wide for the small chunk sizes.
+    'boundary': ([0, 1, 2, 3, 4, 5, 6, 5, 4, 3, 2, 1, 0, 1, 2, 3, 4, 5, 4, 3, 2, 1, 0, 0, 0], 3, [6, 17], [12]),
+}
+
+CHUNK_SIZES = (1, 2, 3, 5, 6, 7, 100)
+
+
+def expected_rows(y, indices):
+    return [[0.5 * i, float(y[i])] for i in indices]
+
+
+def check(name, y, lookahead, max_idx, min_idx):
+    """
+    :return: A list of failure descriptions.
+    """
+    from huji_lab import DataProc
+    x = 0.5 * np.arange(len(y))
+    y = np.asarray(y, dtype=float)
+    want = (expected_rows(y, max_idx), expected_rows(y, min_idx))
+    failures = []
+    got = DataProc.detect_extrema(x, y, lookahead)
+    if [got[0].tolist(), got[1].tolist()] != list(want):
+        failures.append("%s: detect_extrema gave %s, expected %s" % (name, [part.tolist() for part in got], want))
+    for size in CHUNK_SIZES:
+        chunks = ((x[i:i + size], y[i:i + size]) for i in range(0, len(y), size))
+        parts = list(DataProc.detect_extrema_stream(chunks, lookahead))
+        got = [np.concatenate([part[k] for part in parts]).tolist() for k in (0, 1)]
+        if got != list(want):
+            failures.append("%s: detect_extrema_stream (chunks of %d) gave %s, expected %s" % (name, size, got, want))
+    got = DataProc.detect_extrema(x, y, lookahead, chunk_rows=4)
+    if [got[0].tolist(), got[1].tolist()] != list(want):
+        failures.append("%s: detect_extrema (chunk_rows=4) gave %s" % (name, [part.tolist() for part in got]))
+    return failures
+
+
+def main():
+    failures = []
+    for name, case in CASES.items():
+        found = check(name, *case)
+        failures.extend(found)
+        print("%-10s %s" % (name, 'FAIL' if found else 'ok'))
+    for line in failures:
+        print(line)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Synthetic, seeded data generators for the huji_lab benchmarks. No files or network needed.
+"""
+import numpy as np
+
+
+def noisy_line(n, seed=0):
+    """
+    :return: (x, y, y_error) of a line with gaussian noise.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0., 10., n)
+    y_error = rng.uniform(0.1, 0.5, n)
+    return x, 2. * x + 1. + rng.normal(0., y_error), y_error
+
+
+def noisy_sine(n, channels=1, seed=0):
+    """
+    :return: (t, y) with y shaped (channels, n), each channel a sine of a different frequency plus noise.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(n) * 1e-3
+    freq = rng.uniform(5., 50., (channels, 1))
+    y = rng.uniform(1., 3., (channels, 1)) * np.sin(2. * np.pi * freq * t + rng.uniform(-3., 3., (channels, 1)))
+    return t, y + rng.normal(0., 0.3, (channels, n))
+
+
+def peaky_waveform(n, seed=0):
+    """
+    :return: (x, y) of a slow sine with sharp gaussian peaks and noise, for peak detection.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.arange(n, dtype=float)
+    y = np.sin(x * 2. * np.pi / max(n / 20., 10.)) + rng.normal(0., 0.05, n)
+    for center in rng.randint(0, n, max(n // 1000, 1)):
+        width = max(n / 5000., 2.)
+        lo, hi = int(max(center - 5 * width, 0)), int(min(center + 5 * width, n))
+        y[lo:hi] += 3. * np.exp(-0.5 * ((x[lo:hi] - center) / width) ** 2)
+    return x, y
+
+
+def ufloat_table(n, groups=100, seed=0):
+    """
+    :return: (nominals, deviations, group keys) of n measurements.
+    """
+    rng = np.random.RandomState(seed)
+    return rng.normal(5., 1., n), rng.uniform(0.5, 1.5, n), rng.randint(0, groups, n)
+
+
+def ufloats(n, seed=0):
+    """
+    :return: A list of n ufloats.
+    """
+    from uncertainties import ufloat
+    nominals, deviations, _ = ufloat_table(n, seed=seed)
+    return [ufloat(nom, dev) for nom, dev in zip(nominals, deviations)]
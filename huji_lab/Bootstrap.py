@@ -0,0 +1,162 @@
+import numpy as _np
+from huji_lab._lazy import LazyModule as _LazyModule
+from huji_lab._parallel import parallel_map as _parallel_map
+from huji_lab._parallel import split_chunks as _split_chunks
+from huji_lab._parallel import cpu_count as _cpu_count
+from huji_lab.Fitting import fit_it as _fit_it
+from huji_lab.Fitting import linear_basis as _linear_basis
+from huji_lab.Fitting import derive_jacobian as _derive_jacobian
+from huji_lab.Fitting import _svd_inverse
+from huji_lab.Profiling import instrumented as _instrumented
+from huji_lab.Profiling import stage as _stage
+
+_opt = _LazyModule("scipy.optimize")
+_stats = _LazyModule("scipy.stats")
+
+# Replicates per random stream. Streams are spawned per block (not per worker), so results for a given seed
+# don't depend on the number of processes.
+BLOCK_SIZE = 256
+
+
+def _resample(shared, rng, count):
+    """
+    Draws "count" synthetic datasets around the fitted model.
+    :return: An (count, n) array of y values.
+    """
+    model, scale, residuals, method = shared['model'], shared['scale'], shared['residuals'], shared['method']
+    n = len(model)
+    if method == 'residual':
+        return model + scale * residuals[rng.integers(0, n, size=(count, n))]
+    return model + scale * rng.standard_normal((count, n))
+
+
+def _refit_block(shared, blocks):
+    """
+    Refits the synthetic datasets of a list of blocks, in one worker.
+    :param shared: A dictionary of the data, base fit and options (see bootstrap_fit).
+    :param blocks: A list of (SeedSequence, count) tuples.
+    :return: A tuple (samples (m, k), chi2 (m,)) of arrays, nan for failed refits.
+    """
+    x, popt, y_error = shared['x'], shared['popt'], shared['y_error']
+    samples = []
+    chis = []
+    for seed, count in blocks:
+        rng = _np.random.default_rng(seed)
+        y_star = _resample(shared, rng, count)
+        if shared['solver'] is not None:
+            # Linear model: every replicate in one matrix product, target -> (target - f0) / sigma @ solver.T
+            offset, solver, sigma = shared['offset'], shared['solver'], shared['sigma']
+            params = ((y_star - offset) / sigma).dot(solver.T)
+        else:
+            params = _np.full((count, len(popt)), _np.nan)
+            for i in range(count):
+                try:
+                    params[i] = _opt.curve_fit(shared['graph_type'], x, y_star[i], p0=popt, sigma=shared['fit_sigma'],
+                                               absolute_sigma=shared['fit_sigma'] is not None, jac=shared['jac'],
+                                               maxfev=10000)[0]
+                except (RuntimeError, ValueError):
+                    pass
+        chi = _np.full(count, _np.nan)
+        if y_error is not None:
+            with _np.errstate(all='ignore'):
+                if shared['solver'] is not None:
+                    model = shared['offset'] + params.dot(shared['basis'])
+                else:
+                    model = _np.array([_np.asarray(shared['graph_type'](x, *par), dtype=float) * _np.ones(len(x))
+                                       for par in params])
+            chi = _np.sum(((y_star - model) / y_error) ** 2, axis=1)
+        samples.append(params)
+        chis.append(chi)
+    return _np.concatenate(samples), _np.concatenate(chis)
+
+
+@_instrumented
+def bootstrap_fit(x, y, graph_type, y_error=0, n_resamples=1000, method='residual', confidence=0.95, seed=None,
+                  processes=None, p0=None, weighted=False, jac=None, linear=True):
+    """
+    Bootstrap (or Monte Carlo) confidence intervals of fit parameters, and a goodness of fit test.
+    Synthetic datasets are drawn around the fitted model and refitted: 'residual' resamples the fit residuals,
+    'parametric' draws gaussian noise of size y_error (or of the residuals' spread, without y_error).
+    Models linear in their parameters refit all replicates in one matrix product, others refit with curve_fit
+    across a process pool, starting from the best fit.
+    :param x: Horizontal axis data.
+    :param y: Vertical axis data.
+    :param graph_type: Formula of fit. Example: lambda x,a,b: a*x+b.
+    :param y_error: Y Error bar size, for the chi squared and the parametric noise (and as weights if weighted).
+    :param n_resamples: Number of synthetic datasets.
+    :param method: 'residual' or 'parametric'.
+    :param confidence: Confidence level of the percentile intervals.
+    :param seed: Seed of the random streams (int or numpy SeedSequence), same seed == same result.
+    :param processes: Number of worker processes, None for all cores (1 for linear models), 1 for serial.
+    :param p0: Initial guess of the parameters. See fit_it.
+    :param weighted: Weight the fits by 1/y_error^2. See fit_it.
+    :param jac: Jacobian of a nonlinear model, or 'auto'. See fit_it.
+    :param linear: Solve models linear in their parameters in closed form. See fit_it.
+    :return: A dictionary with 'popt' and 'pcov' (best fit), 'samples' (n_resamples, k) refitted parameters,
+             'std' (bootstrap errors), 'intervals' (k, 2) percentile intervals, 'chi2' (not reduced), 'dof',
+             'p-value' (chi2 survival function with n - k degrees of freedom), 'p-value-mc' (fraction of
+             parametric replicates with a larger chi2, nan for the residual method) and 'success' (number of
+             converged refits). chi2 and p-values are nan without y_error.
+    """
+    if method not in ('residual', 'parametric'):
+        raise ValueError("method must be 'residual' or 'parametric'")
+    x = _np.asarray(x, dtype=float)
+    y = _np.asarray(y, dtype=float)
+    y_error = _np.asarray(y_error, dtype=float)
+    has_error = bool(y_error.any())
+    if jac == 'auto':
+        jac = _derive_jacobian(graph_type)
+    with _stage('fit'):
+        fit = _fit_it(x, y, graph_type, y_error, p0, weighted, jac, linear)
+    popt = fit['popt']
+    n, k = len(y), len(popt)
+    dof = n - k
+    if dof < 1:
+        raise ValueError("Bootstrapping needs more data points than parameters")
+    model = _np.asarray(graph_type(x, *popt), dtype=float) * _np.ones(n)
+    errors = _np.broadcast_to(y_error, y.shape).astype(float) if has_error else None
+    fit_sigma = errors if weighted and has_error else None
+
+    # Residuals are standardized by the weights, and inflated by sqrt(n / dof) to undo the fit's shrinking.
+    unit = fit_sigma if fit_sigma is not None else _np.ones(n)
+    residuals = (y - model) / unit * _np.sqrt(float(n) / dof)
+    if method == 'residual':
+        scale = unit
+    elif has_error:
+        scale = errors
+    else:
+        scale = _np.full(n, _np.sqrt(_np.sum((y - model) ** 2) / dof))
+
+    shared = {'x': x, 'popt': popt, 'model': model, 'residuals': residuals, 'scale': scale, 'method': method,
+              'y_error': errors, 'graph_type': graph_type, 'jac': jac, 'fit_sigma': fit_sigma, 'solver': None}
+    basis = _linear_basis(graph_type, x, k) if linear else None
+    if basis is not None:
+        sigma = fit_sigma if fit_sigma is not None else _np.ones(n)
+        u, inverse, vt = _svd_inverse(basis[1].T / sigma[:, None])
+        shared.update(offset=basis[0], basis=basis[1], sigma=sigma, solver=vt.T.dot(u.T * inverse[:, None]))
+        if processes is None:
+            processes = 1
+
+    counts = [min(BLOCK_SIZE, n_resamples - start) for start in range(0, n_resamples, BLOCK_SIZE)]
+    if not isinstance(seed, _np.random.SeedSequence):
+        seed = _np.random.SeedSequence(seed)
+    blocks = list(zip(seed.spawn(len(counts)), counts))
+    with _stage('refit'):
+        parts = _parallel_map(_refit_block, _split_chunks(blocks, _cpu_count(processes)), processes, shared=shared)
+    samples = _np.concatenate([part[0] for part in parts]) if parts else _np.empty((0, k))
+    chis = _np.concatenate([part[1] for part in parts]) if parts else _np.empty(0)
+
+    ok = _np.all(_np.isfinite(samples), axis=1)
+    tail = (1. - confidence) / 2. * 100.
+    chi = _np.nan
+    p_value = p_value_mc = _np.nan
+    if has_error:
+        chi = float(_np.sum(((y - model) / errors) ** 2))
+        p_value = float(_stats.chi2.sf(chi, dof))
+        if method == 'parametric' and ok.any():
+            p_value_mc = float(_np.mean(chis[ok] >= chi))
+    return {'popt': popt, 'pcov': fit['pcov'], 'samples': samples,
+            'std': _np.std(samples[ok], axis=0, ddof=1) if ok.sum() > 1 else _np.full(k, _np.nan),
+            'intervals': _np.percentile(samples[ok], [tail, 100. - tail], axis=0).T if ok.any()
+            else _np.full((k, 2), _np.nan),
+            'chi2': chi, 'dof': dof, 'p-value': p_value, 'p-value-mc': p_value_mc, 'success': int(ok.sum())}
@@ -0,0 +1,149 @@
+import os as _os
+import time as _time
+import hashlib as _hashlib
+import tempfile as _tempfile
+
+
+def default_directory(name):
+    """
+    :param name: Sub directory name. Example: "wolfram"
+    :return: The cache directory, under $HUJI_LAB_CACHE (default: ~/.cache/huji_lab).
+    """
+    root = _os.environ.get('HUJI_LAB_CACHE') or _os.path.join(_os.path.expanduser('~'), '.cache', 'huji_lab')
+    return _os.path.join(root, name)
+
+
+def make_key(*parts):
+    """
+    :param parts: Strings (or bytes) identifying an entry.
+    :return: A file name safe hex digest of the parts.
+    """
+    digest = _hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    """
+    A persistent key -> bytes cache, one file per entry, with LRU eviction by total size and an optional TTL.
+    The write time is kept as the file's mtime (for the TTL), the last access as its atime (for the LRU).
+    Writes are atomic, so several processes may share a directory.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20, ttl=None):
+        """
+        :param directory: Directory of the cache, created if missing.
+        :param max_bytes: Total size above which the least recently used entries are evicted.
+        :param ttl: Seconds after which an entry expires, None to keep entries until evicted.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._size = None  # Running estimate of the total size, None until the first scan
+        if not _os.path.isdir(directory):
+            _os.makedirs(directory)
+
+    def _path(self, key):
+        return _os.path.join(self.directory, key)
+
+    def _expired(self, stat, now):
+        return self.ttl is not None and now - stat.st_mtime > self.ttl
+
+    def get(self, key):
+        """
+        :param key: Entry key (a file name, see make_key).
+        :return: The cached bytes, or None if missing or expired.
+        """
+        path = self._path(key)
+        now = _time.time()
+        try:
+            stat = _os.stat(path)
+            if self._expired(stat, now):
+                _os.remove(path)
+                return None
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            _os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Stores an entry, then evicts old entries if the cache grew above max_bytes.
+        The directory is only scanned when a running size estimate crosses max_bytes (and on the first put), then
+        shrunk to 90% of it, so a batch of puts doesn't stat every entry each time. The estimate counts overwrites
+        twice, which only makes the scan come earlier.
+        :param key: Entry key (a file name, see make_key).
+        :param data: Bytes.
+        :return: None.
+        """
+        handle, tmp_path = _tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with _os.fdopen(handle, 'wb') as fh:
+                fh.write(data)
+            _os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if _os.path.exists(tmp_path):
+                _os.remove(tmp_path)
+            raise
+        if self._size is not None:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_bytes:
+            self.evict(0.9 * self.max_bytes)  # Leave some room, so the next puts don't scan again
+
+    def __contains__(self, key):
+        try:
+            return not self._expired(_os.stat(self._path(key)), _time.time())
+        except OSError:
+            return False
+
+    def evict(self, target=None):
+        """
+        Removes expired entries, then the least recently used ones until the cache fits in max_bytes.
+        :param target: Size to shrink to instead of max_bytes.
+        :return: Number of removed entries.
+        """
+        now = _time.time()
+        entries = []
+        removed = 0
+        for name in _os.listdir(self.directory):
+            if name.startswith('.tmp-'):
+                continue
+            path = self._path(name)
+            try:
+                stat = _os.stat(path)
+                if self._expired(stat, now):
+                    _os.remove(path)
+                    removed += 1
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        target = self.max_bytes if target is None else target
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                _os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+        return removed
+
+    def clear(self):
+        """
+        Removes all the entries.
+        :return: None.
+        """
+        for name in _os.listdir(self.directory):
+            try:
+                _os.remove(self._path(name))
+            except OSError:
+                pass
+        self._size = 0
@@ -1,37 +1,375 @@
-import pandas as _pd
 import numpy as _np
-from analytic_wfm import peakdetect as _peakdetect
-import scipy.optimize as _opt
-import wolframalpha as _wolframalpha
+import os as _os
+from huji_lab._lazy import LazyModule as _LazyModule
+from huji_lab._parallel import parallel_map as _parallel_map
+from huji_lab._parallel import split_chunks as _split_chunks
+from huji_lab._parallel import cpu_count as _cpu_count
+from huji_lab.Profiling import instrumented as _instrumented
+from huji_lab.Profiling import call as _call
+from huji_lab.Profiling import stage as _stage
+from huji_lab.Cache import DiskCache as _DiskCache
+from huji_lab.Cache import default_directory as _default_directory
+from huji_lab.Cache import make_key as _make_key
+from huji_lab.Loaders import iter_chunks as _iter_chunks
+from huji_lab.Loaders import CHUNK_ROWS as _CHUNK_ROWS
 
+_pd = _LazyModule("pandas")
+_opt = _LazyModule("scipy.optimize")
+_signal = _LazyModule("scipy.signal")
+_ndimage = _LazyModule("scipy.ndimage")
+_wolframalpha = _LazyModule("wolframalpha")
+_asyncio = _LazyModule("asyncio")
+_futures = _LazyModule("concurrent.futures")
+_xmltodict = _LazyModule("xmltodict")
+_httpx = _LazyModule("httpx")
 
-def fit_sin(tt, yy):
+WOLFRAM_APP_ID = "RVW9Y2-4XPJG9LX55"
+WOLFRAM_URL = "https://api.wolframalpha.com/v2/query"
+_wolfram_caches = {}
+
+
+@_instrumented
+def fit_sin(tt, yy, max_points=None):
     """
     Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq",
     "period" and "fitfunc"
+    Series longer than max_points are fitted with bounded memory: the guess comes from the first max_points samples,
+    then the fit is refined over spans doubling up to the whole series, each on at most max_points samples drawn at
+    jittered (random within regular strata) positions. The first window should hold a few periods, and "maxcov" then
+    reflects the subsample of the last span. If a refinement diverges (its residuals grow well beyond those of the
+    first window), the whole series is fitted at once instead.
     :param tt: x parameter, a 1D array.
     :param yy: y parameter, a 1D array.
+    :param max_points: Use at most this many samples at a time. Default: Loaders.CHUNK_ROWS for memory mapped input
+                       (Loaders.load_array), else all of them.
     :return: A dictionary containing a sin fit of the data.
     """
-    tt = _np.array(tt)
-    yy = _np.array(yy)
-    ff = _np.fft.fftfreq(len(tt), (tt[1]-tt[0]))   # assume uniform spacing
-    fyy = abs(_np.fft.fft(yy))
-    guess_freq = abs(ff[_np.argmax(fyy[1:])+1])   # excluding the zero frequency "peak", which is related to offset
-    guess_amp = _np.std(yy) * 2.**0.5
-    guess_offset = _np.mean(yy)
+    if max_points is None and isinstance(yy, _np.memmap):
+        max_points = _CHUNK_ROWS
+    tt = _np.asarray(tt)
+    yy = _np.asarray(yy)
+    n = len(yy)
+    span = n if max_points is None else min(n, max(int(max_points), 4))
+    with _stage('fft_guess'):
+        window_t = _np.asarray(tt[:span], dtype=float)
+        window_y = _np.asarray(yy[:span], dtype=float)
+        ff = _np.fft.fftfreq(span, (window_t[1]-window_t[0]))   # assume uniform spacing
+        fyy = abs(_np.fft.fft(window_y))
+        guess_freq = abs(ff[_np.argmax(fyy[1:])+1])   # excluding the zero frequency "peak", which is related to offset
+    guess_amp = _np.std(window_y) * 2.**0.5
+    guess_offset = _np.mean(window_y)
     guess = _np.array([guess_amp, 2.*_np.pi*guess_freq, 0., guess_offset])  # type: float
+    del fyy, ff
+    if span < n:
+        # The window's frequency bins are coarse, guess between them, and solve amplitude and phase for that guess.
+        omega = 2. * _np.pi * _sin_freq_uniform(window_y, window_t[1] - window_t[0])
+        guess = _np.array([0., omega, 0., 0.])
+        guess[[0, 2, 3]] = _sin_linear(window_t, window_y, omega)
 
     def sinfunc(time, amp, angular_freq, phase, const):
         return amp * _np.sin(angular_freq*time + phase) + const
 
-    popt, pcov = _opt.curve_fit(sinfunc, tt, yy, p0=guess)
+    with _stage('curve_fit'):
+        popt, pcov = _opt.curve_fit(sinfunc, window_t, window_y, p0=guess)
+        base = _np.std(window_y - sinfunc(window_t, *popt))
+        del window_t, window_y
+        # One sample at a random position within each of "limit" equal strata: unlike a fixed stride, the subsample
+        # can't alias with the signal. Seeded, so the same data gives the same fit.
+        rng = _np.random.default_rng(0)
+        limit = span
+        while span < n:
+            # Doubling keeps the accumulated phase error of the previous estimate small enough to converge.
+            span = min(2 * span, n)
+            count = min(span, limit)
+            index = ((_np.arange(count) + rng.random(count)) * (float(span) / count)).astype(_np.intp)
+            sample_t = _np.asarray(tt[index], dtype=float)
+            sample_y = _np.asarray(yy[index], dtype=float)
+            popt, pcov = _opt.curve_fit(sinfunc, sample_t, sample_y, p0=popt)
+            # A diverged refinement leaves most of the signal in the residuals.
+            spread = _np.std(sample_y - sinfunc(sample_t, *popt))
+            if not _np.all(_np.isfinite(pcov)) or spread > 2. * base + 1e-3 * _np.std(sample_y):
+                # Fall back to fitting the whole series at once (unbounded memory).
+                popt, pcov = _opt.curve_fit(sinfunc, _np.asarray(tt, dtype=float), _np.asarray(yy, dtype=float),
+                                            p0=guess)
+                break
     a, w, p, c = popt
     f = w/(2.*_np.pi)
     return {"amp": a, "omega": w, "phase": p, "offset": c, "freq": f, "period": 1./f,
             "fitfunc": lambda t: a * _np.sin(w*t + p) + c, "maxcov": _np.max(pcov), "rawres": (guess, popt, pcov)}
 
 
+def _sin_freq_uniform(yy, dt):
+    """
+    Estimates the dominant frequency of a uniformly sampled signal, with sub-bin accuracy.
+    Uses a Hann windowed rfft and a parabolic interpolation of the log-magnitude around the peak bin.
+    :param yy: A 1D array.
+    :param dt: Sampling interval.
+    :return: The frequency (not angular).
+    """
+    n = len(yy)
+    spec = _np.abs(_np.fft.rfft((yy - yy.mean()) * _np.hanning(n)))
+    k = _np.argmax(spec[1:]) + 1  # excluding the zero frequency "peak", which is related to offset
+    delta = 0.
+    if k < len(spec) - 1:
+        a, b, c = _np.log(spec[k - 1:k + 2] + 1e-300)
+        if a - 2 * b + c < 0:
+            delta = 0.5 * (a - c) / (a - 2 * b + c)
+    return (k + delta) / (n * dt)
+
+
+def _sin_freq_nonuniform(tt, yy):
+    """
+    Estimates the dominant frequency of a non-uniformly sampled signal.
+    A coarse guess from the rfft of the signal resampled on a uniform grid, refined by a narrow Lomb-Scargle
+    periodogram evaluated on the true sample times.
+    :param tt: A 1D array of sorted sample times.
+    :param yy: A 1D array.
+    :return: The frequency (not angular).
+    """
+    n = len(tt)
+    span = tt[-1] - tt[0]
+    grid = _np.linspace(tt[0], tt[-1], n)
+    guess = _sin_freq_uniform(_np.interp(grid, tt, yy), span / (n - 1))
+    freqs = _np.linspace(max(guess - 2. / span, 0.5 / span), guess + 2. / span, 201)
+    power = _signal.lombscargle(tt, yy - yy.mean(), 2. * _np.pi * freqs)
+    return freqs[_np.argmax(power)]
+
+
+def _sin_linear(tt, yy, omega):
+    """
+    Solves amplitude, phase and offset of a sin with a known angular frequency, by linear least squares.
+    :return: A tuple (amp, phase, offset).
+    """
+    design = _np.column_stack((_np.sin(omega * tt), _np.cos(omega * tt), _np.ones_like(tt)))
+    (s, c, offset), _, _, _ = _np.linalg.lstsq(design, yy, rcond=None)
+    return _np.hypot(s, c), _np.arctan2(c, s), offset
+
+
+def _sin_jacobian(time, amp, angular_freq, phase, const):
+    arg = angular_freq * time + phase
+    cos_arg = _np.cos(arg)
+    return _np.column_stack((_np.sin(arg), amp * time * cos_arg, amp * cos_arg, _np.ones_like(time)))
+
+
+def _fit_sin_channels(shared, channels):
+    """
+    Fits a sin to a subset of channels, in one worker.
+    :param shared: A tuple (tt, yy, uniform, polish), tt is 1D or 2D.
+    :param channels: Indices of the channels to fit.
+    :return: A list of (popt, pcov) tuples.
+    """
+    tt, yy, uniform, polish = shared
+    results = []
+    for ch in channels:
+        t = tt if tt.ndim == 1 else tt[ch]
+        y = _np.asarray(yy[ch], dtype=float)
+        if uniform:
+            freq = _sin_freq_uniform(y, (t[-1] - t[0]) / (len(t) - 1))
+        else:
+            order = _np.argsort(t, kind='stable')
+            t, y = t[order], y[order]
+            freq = _sin_freq_nonuniform(t, y)
+        amp, phase, offset = _sin_linear(t, y, 2. * _np.pi * freq)
+        popt = _np.array([amp, 2. * _np.pi * freq, phase, offset])
+        pcov = _np.full((4, 4), _np.nan)
+        if polish:
+            try:
+                popt, pcov = _opt.curve_fit(lambda time, a, w, p, c: a * _np.sin(w * time + p) + c, t, y,
+                                            p0=popt, jac=_sin_jacobian)
+            except (RuntimeError, ValueError, TypeError):  # TypeError: fewer points than parameters
+                pass
+        results.append((popt, pcov))
+    return results
+
+
+@_instrumented
+def fit_sin_many(tt, yy, polish=True, processes=None):
+    """
+    Fits a sin to many channels at once, returning the fit_sin parameters as arrays (one entry per channel).
+    The frequency is guessed from an interpolated rfft peak, then amplitude, phase and offset are solved by
+    linear least squares, and (optionally) everything is polished by a nonlinear fit.
+    Non-uniform time bases are detected, and go through a Lomb-Scargle periodogram instead of the rfft.
+    :param tt: Time, a 1D array shared by all channels, or a 2D array (channels, samples).
+    :param yy: A 2D array (channels, samples), or a 1D array for a single channel.
+    :param polish: Refine the linear solution with a nonlinear least squares fit (gives "maxcov").
+    :param processes: Number of worker processes, None for all cores, 1 for serial.
+    :return: A dictionary of arrays: "amp", "omega", "phase", "offset", "freq", "period", "maxcov", and "popt".
+    """
+    tt = _np.asarray(tt, dtype=float)
+    yy = _np.atleast_2d(_np.asarray(yy))
+    steps = _np.diff(tt, axis=-1)
+    uniform = bool(_np.allclose(steps, steps[..., :1], rtol=1e-6, atol=0))
+    chunks = _split_chunks(list(range(len(yy))), _cpu_count(processes))
+    with _stage('fit'):
+        results = [res for part in _parallel_map(_fit_sin_channels, chunks, processes, shared=(tt, yy, uniform, polish))
+                   for res in part]
+    popt = _np.array([res[0] for res in results])
+    maxcov = _np.array([_np.max(res[1]) for res in results])
+    a, w, p, c = popt.T
+    f = w / (2. * _np.pi)
+    return {"amp": a, "omega": w, "phase": p, "offset": c, "freq": f, "period": 1. / f, "maxcov": maxcov,
+            "popt": popt}
+
+
+def _extrema_indices(y, lookahead, start, phase):
+    """
+    Finds alternating maxima and minima with a lookahead, same rules as analytic_wfm.peakdetect (delta=0).
+    A point is a peak candidate if it is strictly larger (smaller) than the next "lookahead" points. Searching
+    from "start", the first candidate of the sought kind is a peak, and the search for the opposite kind
+    resumes two points after it. Only points with lookahead + 1 points after them can be peaks.
+    :param y: A 1D array.
+    :param lookahead: Int, the lookahead.
+    :param start: Index to start searching from.
+    :param phase: Kind of peak sought: 'max', 'min' or 'both' (before the first peak).
+    :return: A tuple (maxima indices, minima indices, next start, next phase).
+    """
+    last = len(y) - lookahead - 2
+    if last < start:
+        return _np.empty(0, dtype=int), _np.empty(0, dtype=int), start, phase
+    with _stage('filters'):
+        tail = y[start:]
+        shift = lookahead // 2 + 1  # maximum_filter1d window of index k + shift is tail[k + 1:k + 1 + lookahead]
+        head = tail[:last - start + 1]
+        ahead_max = _ndimage.maximum_filter1d(tail, lookahead, mode='nearest')[shift:shift + len(head)]
+        max_cands = _np.flatnonzero(head > ahead_max) + start
+        del ahead_max
+        ahead_min = _ndimage.minimum_filter1d(tail, lookahead, mode='nearest')[shift:shift + len(head)]
+        min_cands = _np.flatnonzero(head < ahead_min) + start
+        del ahead_min
+
+    with _stage('alternation'):
+        maxima = []
+        minima = []
+        while True:
+            next_max = next_min = None
+            if phase != 'min':
+                pos = _np.searchsorted(max_cands, start)
+                next_max = max_cands[pos] if pos < len(max_cands) else None
+            if phase != 'max':
+                pos = _np.searchsorted(min_cands, start)
+                next_min = min_cands[pos] if pos < len(min_cands) else None
+            if next_max is not None and (next_min is None or next_max < next_min):
+                # On ties, the peak is reported at the first occurrence of its value.
+                maxima.append(start + _np.argmax(y[start:next_max + 1]))
+                start, phase = next_max + 2, 'min'
+            elif next_min is not None:
+                minima.append(start + _np.argmin(y[start:next_min + 1]))
+                start, phase = next_min + 2, 'max'
+            else:
+                break
+    return _np.array(maxima, dtype=int), _np.array(minima, dtype=int), start, phase
+
+
+def _drop_first_hit(maxima, minima):
+    """
+    Drops the first peak found (it is almost always false), like analytic_wfm.peakdetect does.
+    """
+    if len(maxima) and (not len(minima) or maxima[0] < minima[0]):
+        return maxima[1:], minima
+    if len(minima):
+        return maxima, minima[1:]
+    return maxima, minima
+
+
+def _extrema_frame(maxima, minima):
+    frame = _pd.DataFrame(_np.concatenate((maxima, minima)), columns=['Column1', 'Column2'])
+    frame['Type'] = ['max'] * len(maxima) + ['min'] * len(minima)
+    return frame.sort_values('Column1', kind='stable').reset_index(drop=True)
+
+
+@_instrumented
+def detect_extrema(x, y, sensitivity=100, as_frame=False, chunk_rows=None):
+    """
+    Takes two 1D arrays (x,y) and returns both MAXIMAS and MINIMAS in one pass.
+    Same results as analytic_wfm.peakdetect (with delta=0), without a python loop over the samples.
+    :param x: A 1D array.
+    :param y: A 1D array.
+    :param sensitivity: Int representing the lookahead for maximas/minimas detection.
+    :param as_frame: Return a single dataframe (with a 'Type' column, 'max' or 'min') instead of two arrays.
+    :param chunk_rows: Process the signal in chunks of this many rows, to bound memory use.
+                       Default: chunks of Loaders.CHUNK_ROWS for memory mapped input (Loaders.load_array), else None.
+    :return: A tuple of two (n, 2) arrays of (x, y) rows: (maximas, minimas), or a pandas dataframe.
+    """
+    if sensitivity < 1:
+        raise ValueError("Lookahead must be '1' or above in value")
+    x = _np.asarray(x)
+    if chunk_rows is None and isinstance(y, _np.memmap):
+        chunk_rows = _CHUNK_ROWS
+    y = _np.asarray(y)
+    if len(x) != len(y):
+        raise ValueError("Input vectors y and x must have same length")
+    if chunk_rows is not None and len(y) > chunk_rows:
+        found = list(detect_extrema_stream(_iter_chunks(x, y, chunk_rows), sensitivity))
+        maxima = _np.concatenate([peaks[0] for peaks in found])
+        minima = _np.concatenate([peaks[1] for peaks in found])
+    else:
+        max_idx, min_idx, _, _ = _extrema_indices(y, sensitivity, 0, 'both')
+        max_idx, min_idx = _drop_first_hit(max_idx, min_idx)
+        maxima = _np.column_stack((x[max_idx], y[max_idx]))
+        minima = _np.column_stack((x[min_idx], y[min_idx]))
+    if as_frame:
+        return _extrema_frame(maxima, minima)
+    return maxima, minima
+
+
+def detect_extrema_stream(chunks, sensitivity=100):
+    """
+    Streaming version of detect_extrema, for signals too large for memory (Example: read from disk in chunks).
+    State is carried across chunk boundaries, so the peaks are the same as for the whole signal at once.
+    :param chunks: An iterable of (x, y) pairs of 1D arrays, consecutive pieces of the signal.
+    :param sensitivity: Int representing the lookahead for maximas/minimas detection.
+    :return: A generator, yielding a (maximas, minimas) tuple of (n, 2) arrays for the peaks confirmed so far.
+             The peaks near the end of a chunk may only be yielded with the next one.
+    """
+    if sensitivity < 1:
+        raise ValueError("Lookahead must be '1' or above in value")
+    buf_x = _np.empty(0)
+    buf_y = _np.empty(0)
+    offset = 0  # global index of buf_y[0]
+    start = 0
+    phase = 'both'
+    first_dropped = False
+    # First occurrence (x, y) of the largest/smallest value dropped from the buffer since the search start,
+    # for reporting ties at their first occurrence.
+    dropped_max = dropped_min = None
+    for x, y in chunks:
+        buf_x = _np.concatenate((buf_x, _np.asarray(x, dtype=float)))
+        buf_y = _np.concatenate((buf_y, _np.asarray(y, dtype=float)))
+        with _call('detect_extrema_stream'):
+            max_idx, min_idx, start_local, phase = _extrema_indices(buf_y, sensitivity, start - offset, phase)
+        maxima = _np.column_stack((buf_x[max_idx], buf_y[max_idx]))
+        minima = _np.column_stack((buf_x[min_idx], buf_y[min_idx]))
+        first_is_max = len(max_idx) > 0 and (not len(min_idx) or max_idx[0] < min_idx[0])
+        if first_is_max and dropped_max is not None and dropped_max[1] == maxima[0, 1]:
+            maxima[0] = dropped_max
+        elif not first_is_max and len(min_idx) and dropped_min is not None and dropped_min[1] == minima[0, 1]:
+            minima[0] = dropped_min
+        if len(max_idx) or len(min_idx):
+            dropped_max = dropped_min = None
+            if not first_dropped:
+                if first_is_max:
+                    maxima = maxima[1:]
+                else:
+                    minima = minima[1:]
+                first_dropped = True
+        # Points before len - lookahead - 1 are decided, keep the rest (and anything after the search start).
+        keep = max(min(start_local, len(buf_y)), len(buf_y) - sensitivity - 1, 0)
+        if keep > start_local:
+            seg = slice(start_local, keep)
+            i_max = start_local + _np.argmax(buf_y[seg])
+            i_min = start_local + _np.argmin(buf_y[seg])
+            if dropped_max is None or buf_y[i_max] > dropped_max[1]:
+                dropped_max = (buf_x[i_max], buf_y[i_max])
+            if dropped_min is None or buf_y[i_min] < dropped_min[1]:
+                dropped_min = (buf_x[i_min], buf_y[i_min])
+        start = offset + max(start_local, keep)
+        offset += keep
+        buf_x = buf_x[keep:]
+        buf_y = buf_y[keep:]
+        yield maxima, minima
+
+
+@_instrumented
 def detect_maxima(x, y, sensitivity=100):
     """
     Takes two 1D arrays (x,y) and returns a dataframe of MAXIMAS. Optional controls the lookahead parameter
@@ -40,10 +378,11 @@ def detect_maxima(x, y, sensitivity=100):
     :param sensitivity: Int representing the lookahead for maximas detection.
     :return: A pandas dataframe containing local Maximas.
     """
-    peaks = _peakdetect(_np.array(y), _np.array(x), lookahead=sensitivity)[0]
-    return _pd.DataFrame.from_records(peaks, columns=['Column1', 'Column2'])
+    peaks = detect_extrema(x, y, sensitivity)[0]
+    return _pd.DataFrame(peaks, columns=['Column1', 'Column2'])
 
 
+@_instrumented
 def detect_minima(x, y, sensitivity=100):
     """
     Takes two 1D arrays (x,y) and returns a dataframe of MINIMAS. Optional controls the lookahead parameter
@@ -52,29 +391,283 @@ def detect_minima(x, y, sensitivity=100):
     :param sensitivity: Int representing the lookahead for minimas detection.
     :return: A pandas dataframe containing local Minimas.
     """
-    peaks = _peakdetect(y, x, lookahead=sensitivity)[1]
-    return _pd.DataFrame.from_records(peaks, columns=['Column1', 'Column2'])
+    peaks = detect_extrema(x, y, sensitivity)[1]
+    return _pd.DataFrame(peaks, columns=['Column1', 'Column2'])
+
+
+def decimate(x, y, max_points):
+    """
+    Shape-preserving downsampling for display: keeps the min and max of y in each of max_points/2 bins of x,
+    so peaks and the signal envelope survive. Fit on the full data, plot the decimated one.
+    :param x: A 1D array.
+    :param y: A 1D array.
+    :param max_points: Maximal number of points to keep.
+    :return: Sorted indices of the kept points.
+    """
+    x = _np.asarray(x)
+    y = _np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= max_points:
+        return _np.arange(n)
+    order = None if _np.all(x[1:] >= x[:-1]) else _np.argsort(x, kind='stable')
+    ordered = y if order is None else y[order]
+    size = -(-n // max((max_points - 2) // 2, 1))  # two points per bin, plus both ends
+    bins = -(-n // size)
+    padded = _np.full(bins * size, _np.nan)
+    padded[:n] = ordered
+    padded = padded.reshape(bins, size)
+    starts = _np.arange(bins) * size
+    with _np.errstate(invalid='ignore'):
+        filled = _np.isnan(padded).all(axis=1)
+        padded[filled, 0] = 0.  # bins of nan only, keep their first point
+        kept = _np.concatenate((starts + _np.nanargmin(padded, axis=1), starts + _np.nanargmax(padded, axis=1),
+                                [0, n - 1]))
+    kept = _np.unique(kept)
+    return kept if order is None else _np.sort(order[kept])
 
 
 def freq_over_time_calculator(time_list):
     """
     Takes a list of times of recurring event, and returns approximated frequency.
-    When dealing with Sin() events, use fit_sin for better results.
+    When dealing with Sin() events, use fit_sin for better results. For a stream of events, see EventRateEstimator.
     :param time_list: A list of Ints representing times of recurring events.
-    :return: A numpy array of approximated frequencies.
+    :return: A numpy array of approximated frequencies, nan for zero intervals (duplicate times).
+    """
+    intervals = _np.abs(_np.diff(_np.asarray(time_list, dtype=float)))
+    with _np.errstate(divide='ignore'):
+        over_time = 1. / intervals
+    over_time[intervals == 0] = _np.nan
+    return over_time
+
+
+class EventRateEstimator(object):
+    """
+    Streaming version of freq_over_time_calculator: estimates the rate of recurring events from batches of
+    timestamps, with bounded memory. Keeps a sliding window count (in "bins" time bins) and an exponentially
+    weighted rate, both defined by event counts rather than intervals, so duplicate timestamps are just
+    coincident events.
+    """
+
+    def __init__(self, window=1., halflife=None, bins=100):
+        """
+        :param window: Length of the sliding window, in time units of the timestamps.
+        :param halflife: Half life of the exponential weights, defaults to the window.
+        :param bins: Number of bins the window is counted in (its time resolution is window / bins).
+        """
+        if window <= 0 or bins < 1:
+            raise ValueError("window and bins must be positive")
+        self.window = float(window)
+        self.tau = (self.window if halflife is None else float(halflife)) / _np.log(2.)
+        self.bins = int(bins)
+        self._width = self.window / self.bins
+        self._counts = _np.zeros(self.bins, dtype=_np.int64)  # Ring buffer, bin k is at k % bins
+        self._head = 0  # Index of the latest bin, counted from origin
+        self._weight = 0.  # Sum of exp(-(last_time - t) / tau) / tau over the events
+        self.origin = None
+        self.last_time = None
+        self.count = 0
+
+    def add(self, times):
+        """
+        Adds a batch of event timestamps (in any order; events older than the window only count in the
+        exponentially weighted rate).
+        :param times: A number or an array of timestamps.
+        :return: The estimator itself.
+        """
+        times = _np.sort(_np.asarray(times, dtype=float).ravel())
+        times = times[_np.isfinite(times)]
+        if not len(times):
+            return self
+        if self.origin is None:
+            self.origin = self.last_time = times[0]
+        last_time = max(self.last_time, times[-1])
+        self._weight = (self._weight * _np.exp((self.last_time - last_time) / self.tau) +
+                        _np.sum(_np.exp((times - last_time) / self.tau)) / self.tau)
+        self.last_time = last_time
+        self.count += len(times)
+
+        index = _np.floor((times - self.origin) / self._width).astype(_np.int64)
+        head = max(self._head, int(index[-1]))
+        if head - self._head >= self.bins:
+            self._counts[:] = 0
+        elif head > self._head:
+            self._counts[_np.arange(self._head + 1, head + 1) % self.bins] = 0
+        self._head = head
+        index = index[index > head - self.bins]
+        self._counts += _np.bincount(index % self.bins, minlength=self.bins)
+        return self
+
+    def _now(self, now):
+        return self.last_time if now is None else max(float(now), self.last_time)
+
+    def window_rate(self, now=None):
+        """
+        Events per time unit in the sliding window ending at "now" (over the elapsed time, before a full window).
+        :param now: Time to evaluate the rate at, defaults to the last event time.
+        :return: The rate, nan before two distinct event times.
+        """
+        if not self.count:
+            return _np.nan
+        now = self._now(now)
+        current = int(_np.floor((now - self.origin) / self._width))
+        oldest = current - self.bins + 1
+        if oldest > self._head:
+            return 0.
+        total = int(self._counts[_np.arange(max(oldest, self._head - self.bins + 1), self._head + 1)
+                                 % self.bins].sum())
+        start = self.origin + oldest * self._width
+        if start <= self.origin:
+            # The window still holds the first event, which only marks the start of the first interval.
+            start = self.origin
+            total -= 1
+        duration = now - start
+        return float(total / duration) if duration > 0 else _np.nan
+
+    def ewma_rate(self, now=None):
+        """
+        Exponentially weighted events per time unit, corrected for the start up (like a mean of the events so far).
+        :param now: Time to evaluate the rate at, defaults to the last event time.
+        :return: The rate, nan before two distinct event times.
+        """
+        if not self.count:
+            return _np.nan
+        now = self._now(now)
+        elapsed = now - self.origin
+        if elapsed <= 0:
+            return _np.nan
+        # Without the first event's weight, which (like in window_rate) only marks the start of the first interval.
+        weight = self._weight * _np.exp((self.last_time - now) / self.tau) - _np.exp(-elapsed / self.tau) / self.tau
+        return float(weight / -_np.expm1(-elapsed / self.tau))
+
+    def __repr__(self):
+        return "EventRateEstimator(count=%d, window_rate=%r, ewma_rate=%r)" % (self.count, self.window_rate(),
+                                                                             self.ewma_rate())
+
+
+def wolfram_cache(directory=None, max_bytes=256 * 2 ** 20, ttl=30 * 24 * 3600.):
+    """
+    The on-disk cache of wolframAlpha responses and images (shared per directory).
+    :param directory: Cache directory, None for $HUJI_LAB_CACHE/wolfram (default: ~/.cache/huji_lab/wolfram).
+    :param max_bytes: Total size above which the least recently used entries are evicted.
+    :param ttl: Seconds after which an entry is fetched again, None to keep entries until evicted.
+    :return: A Cache.DiskCache.
+    """
+    directory = directory or _default_directory('wolfram')
+    if directory not in _wolfram_caches:
+        _wolfram_caches[directory] = _DiskCache(directory, max_bytes, ttl)
+    return _wolfram_caches[directory]
+
+
+def _offline(offline):
+    if offline is None:
+        return _os.environ.get('HUJI_LAB_OFFLINE', '') not in ('', '0')
+    return offline
+
+
+def _run(coroutine):
+    """
+    Runs a coroutine to completion, also from inside a running event loop (Example: a jupyter notebook).
+    """
+    try:
+        _asyncio.get_running_loop()
+    except RuntimeError:
+        return _asyncio.run(coroutine)
+    with _futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(_asyncio.run, coroutine).result()
+
+
+async def _fetch_all(requests, cache, offline, max_concurrency, validate=None):
+    """
+    Fetches many urls concurrently over one http client, through the cache.
+    :param requests: A list of (url, params) tuples.
+    :param cache: A DiskCache, or None.
+    :param offline: Only use the cache, raise LookupError for anything missing.
+    :param max_concurrency: Max requests in flight.
+    :param validate: Optional function of the response bytes, raising for responses that must not be cached.
+    :return: A list of response bytes.
+    """
+    keys = [_make_key(url, sorted(params.items())) for url, params in requests]
+    found = {}
+    for key in set(keys):
+        data = cache.get(key) if cache is not None else None
+        if data is not None:
+            found[key] = data
+    missing = dict((key, req) for key, req in zip(keys, requests) if key not in found)
+    if missing and offline:
+        raise LookupError("%d request(s) not in the cache (offline mode), first: %r" % (
+            len(missing), next(iter(missing.values()))))
+    if missing:
+        semaphore = _asyncio.Semaphore(max_concurrency)
+        async with _httpx.AsyncClient(timeout=30., follow_redirects=True) as client:
+            async def fetch(key, url, params):
+                async with semaphore:
+                    resp = await client.get(url, params=params)
+                resp.raise_for_status()
+                if validate is not None:
+                    validate(resp.content)
+                if cache is not None:
+                    cache.put(key, resp.content)
+                found[key] = resp.content
+            await _asyncio.gather(*[fetch(key, url, params) for key, (url, params) in missing.items()])
+    return [found[key] for key in keys]
+
+
+def _parse_wolfram(data):
+    """
+    Parses a raw wolframAlpha response, the same way wolframalpha.Client.query does.
+    """
+    doc = _xmltodict.parse(data, postprocessor=_wolframalpha.Document.make)
+    if 'error' in doc:
+        error = doc['error']
+        raise ValueError("Error %s: %s" % (error['@status'], error['@message']))
+    return doc['queryresult']
+
+
+async def wolfram_aquery_many(queries, cache=True, offline=None, url=None, max_concurrency=8):
+    """
+    Coroutine version of wolfram_query_many, for use inside a running event loop.
+    """
+    store = wolfram_cache() if cache is True else (cache or None)
+    requests = [(url or WOLFRAM_URL, {'appid': WOLFRAM_APP_ID, 'input': query}) for query in queries]
+    raw = await _fetch_all(requests, store, _offline(offline), max_concurrency, validate=_parse_wolfram)
+    return [_parse_wolfram(data) for data in raw]
+
+
+def wolfram_query_many(queries, cache=True, offline=None, url=None, max_concurrency=8):
+    """
+    Sends many queries to wolfram concurrently (one http client), answering repeated queries from the cache.
+    :param queries: A list of strings containing wolframAlpha queries.
+    :param cache: True for the default on-disk cache (see wolfram_cache), a Cache.DiskCache, or False.
+    :param offline: Replay from the cache only, raising LookupError for queries not in it.
+                    None reads the HUJI_LAB_OFFLINE environment variable.
+    :param url: API url, None for wolframAlpha (Example: a local stub server for testing).
+    :param max_concurrency: Max queries in flight.
+    :return: A list of dictionaries containing the wolframAlpha results, in the order of queries.
+    """
+    return _run(wolfram_aquery_many(queries, cache, offline, url, max_concurrency))
+
+
+def wolfram_images(urls, cache=True, offline=None, max_concurrency=8):
+    """
+    Downloads images (Example: the subpods of a wolfram_query result) concurrently, through the cache.
+    :param urls: A list of image urls.
+    :param cache: True for the default on-disk cache (see wolfram_cache), a Cache.DiskCache, or False.
+    :param offline: Use the cache only. None reads the HUJI_LAB_OFFLINE environment variable.
+    :param max_concurrency: Max downloads in flight.
+    :return: A list of image bytes.
     """
-    over_time = []
-    for pair in range(len(time_list)-1):
-        over_time.append(float(1/_np.abs(time_list[pair + 1] - time_list[pair])))
-    return _np.array(over_time)
+    store = wolfram_cache() if cache is True else (cache or None)
+    return _run(_fetch_all([(img_url, {}) for img_url in urls], store, _offline(offline), max_concurrency))
 
 
-def wolfram_query(c_query):
+def wolfram_query(c_query, cache=True, offline=None, url=None):
     """
     Send a query to wolfram. Use Lab.Display.print_wolfram() for a nicely printed output.
+    Responses are cached on disk, so repeated queries don't go to the network (see wolfram_query_many).
     :param c_query: A string containing a wolframAlpha query.
+    :param cache: True for the default on-disk cache (see wolfram_cache), a Cache.DiskCache, or False.
+    :param offline: Replay from the cache only. None reads the HUJI_LAB_OFFLINE environment variable.
+    :param url: API url, None for wolframAlpha.
     :return: A dictionary containing the wolframAlpha result.
     """
-    app_id = "RVW9Y2-4XPJG9LX55"
-    client = _wolframalpha.Client(app_id)
-    return client.query(c_query)
+    return wolfram_query_many([c_query], cache, offline, url, 1)[0]
@@ -1,8 +1,7 @@
-import matplotlib.pyplot as _plt
-from IPython.display import Image as _Image
-from IPython.display import display as _display
-from IPython.display import Markdown as _Markdown
-from IPython.display import Latex as _Latex
+from huji_lab._lazy import LazyModule as _LazyModule
+
+_plt = _LazyModule("matplotlib.pyplot")
+_ipd = _LazyModule("IPython.display")
 
 """
 # A dangerous override function, currently unimplemented.
@@ -22,10 +21,10 @@ def is_ufloat(num):
 def print_color_bold(string, color):
     if color != 'none':
         num = str(string)
-        text_line = _Markdown("<span style=\"color: " + color + "\">**" + num + "**</span>")  # type: tuple
-        _display(text_line)
+        text_line = _ipd.Markdown("<span style=\"color: " + color + "\">**" + num + "**</span>")  # type: tuple
+        _ipd.display(text_line)
     else:
-        _display(string)
+        _ipd.display(string)
         
 global print
 print = is_ufloat
@@ -33,8 +32,8 @@ print = is_ufloat
 
 
 def print_color_bold(string, color='black'):
-    text_line = _Markdown("<span style=\"color: " + color + "\">**" + string + "**</span>")  # type: tuple
-    _display(text_line)
+    text_line = _ipd.Markdown("<span style=\"color: " + color + "\">**" + string + "**</span>")  # type: tuple
+    _ipd.display(text_line)
 
 
 def _print_latex_old(text_to_print):
@@ -53,21 +52,32 @@ def _print_latex_old(text_to_print):
 
 
 def print_latex(text_to_print):
-    return _Latex(text_to_print)
+    return _ipd.Latex(text_to_print)
 
 
-def print_wolfram(wolf_query):
+def print_wolfram(wolf_query, cache=True, offline=None):
     """
     Nicely prints a wolframAlpha query as a series of photos.
+    The images are downloaded once (concurrently, through the wolfram cache) and embedded in the output,
+    instead of being fetched by url on every render.
     :param wolf_query: A wolfram_query() object.
+    :param cache: True for the default wolfram cache, a Cache.DiskCache, or False to display the images by url.
+    :param offline: Use cached images only. None reads the HUJI_LAB_OFFLINE environment variable.
     :return: None.
     """
+    urls = []
     for result in wolf_query['pod']:
         outer = result['subpod']
-        if type(outer) is dict:
-            disp = _Image(url=outer['img']['@src'])  # type: tuple
-            _display(disp)
+        if isinstance(outer, dict):
+            urls.append(outer['img']['@src'])
         else:
             for i in range(len(outer)):
-                disp = _Image(url=outer[i]['img']['@src'])  # type: tuple
-                _display(disp)
+                urls.append(outer[i]['img']['@src'])
+    if not cache:
+        for url in urls:
+            _ipd.display(_ipd.Image(url=url))
+        return
+    from huji_lab.DataProc import wolfram_images
+    for data in wolfram_images(urls, cache, offline):
+        disp = _ipd.Image(data=data)  # type: tuple
+        _ipd.display(disp)
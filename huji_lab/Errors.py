@@ -1,9 +1,15 @@
 import numpy as _np
 from math import sqrt as _sqrt
-from uncertainties import ufloat as _ufloat
-from uncertainties.core import Variable as _varu
-from sympy import symbols as _symbols
-from sympy import diff as _diff
+from functools import lru_cache as _lru_cache
+from huji_lab._lazy import LazyModule as _LazyModule
+from huji_lab._parallel import parallel_map as _parallel_map
+
+_unc = _LazyModule("uncertainties")
+_unc_core = _LazyModule("uncertainties.core")
+_unumpy = _LazyModule("uncertainties.unumpy")
+_stats = _LazyModule("scipy.stats")
+_pd = _LazyModule("pandas")
+_sympy = _LazyModule("sympy")
 
 
 def chi_squared(xdata, ydata, popt, staterror, func):
@@ -33,12 +39,91 @@ def measurements_deviation_calculator(measurements):
     :param measurements: An array of measurements.
     :return: A ufloat, as <x>+/-dx
     """
-    measurements = _np.array(measurements)
-    mean_measurements = measurements.mean()
-    n = len(measurements)
-    sigma = _sqrt(sum((measurements - mean_measurements) ** 2)/(n-1))
-    stats_error = sigma / _sqrt(n)
-    return _ufloat(mean_measurements, stats_error)
+    mean_measurements, stats_error = measurements_deviation(_np.asarray(measurements).ravel())
+    return _unc.ufloat(mean_measurements, stats_error)
+
+
+def measurements_deviation(measurements, axis=-1):
+    """
+    Vectorized measurements_deviation_calculator, for a 2D (or ND) array of repeated measurements.
+    :param measurements: An array of measurements.
+    :param axis: The axis along which the measurements are repeated.
+    :return: A tuple of arrays (mean, statistical error), the given axis reduced.
+    """
+    measurements = _np.asarray(measurements, dtype=float)
+    n = measurements.shape[axis]
+    return measurements.mean(axis=axis), measurements.std(axis=axis, ddof=1) / _sqrt(n)
+
+
+class MeasurementAccumulator(object):
+    """
+    Online (Welford) version of measurements_deviation_calculator, for streaming measurements.
+    Keeps only the count, mean and sum of squared deviations. Accumulators from different workers can be merged.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # Sum of squared deviations from the mean
+
+    def add(self, values):
+        """
+        Adds a single measurement, or a batch of them.
+        :param values: A number or an array of measurements.
+        :return: The accumulator itself.
+        """
+        values = _np.asarray(values, dtype=float).ravel()
+        if len(values) == 1:
+            value = float(values[0])
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+        elif len(values):
+            batch_mean = values.mean()
+            self._combine(len(values), float(batch_mean), float(_np.sum((values - batch_mean) ** 2)))
+        return self
+
+    def merge(self, other):
+        """
+        Merges another accumulator into this one (Chan et al. parallel combine).
+        :param other: A MeasurementAccumulator.
+        :return: The accumulator itself.
+        """
+        if other.count:
+            self._combine(other.count, other.mean, other.m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def variance(self):
+        """
+        The sample variance (n-1 normalization), nan with less than two measurements.
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else _np.nan
+
+    @property
+    def stats_error(self):
+        """
+        The statistical error of the mean, sigma / sqrt(n).
+        """
+        return _sqrt(self.variance / self.count) if self.count > 1 else _np.nan
+
+    def ufloat(self):
+        """
+        :return: A ufloat, as <x>+/-dx
+        """
+        return _unc.ufloat(self.mean, self.stats_error)
+
+    def __repr__(self):
+        return "MeasurementAccumulator(count=%d, mean=%r, stats_error=%r)" % (self.count, self.mean,
+                                                                              self.stats_error)
 
 
 def results_sum_with_deviation(results):
@@ -47,16 +132,172 @@ def results_sum_with_deviation(results):
     :param results: An array of ufloats.
     :return: A ufloat.
     """
-    nominator = []
-    denominator = []
     for result in results:
-        if type(result) is not _varu:
+        if type(result) is not _unc_core.Variable:
             print("Error, The input array is not of ufloat")
             return
+    res = weighted_mean([result.nominal_value for result in results], [result.std_dev for result in results])
+    return _unc.ufloat(res['mean'], res['sigma'])
+
+
+def weighted_mean(nominals, deviations, groups=None, consistency=False, as_ufloat=False):
+    """
+    Inverse-variance weighted mean of measurements, optionally per group. Array version of
+    results_sum_with_deviation.
+    :param nominals: An array of measurement results.
+    :param deviations: An array of the measurements deviations (must be positive).
+    :param groups: An array of group keys (Example: run numbers), None for a single group.
+    :param consistency: Also calculate the reduced chi-squared (and its p-value) of each group around its mean.
+    :param as_ufloat: Also return the means as ufloats.
+    :return: A dictionary with 'mean' and 'sigma' (scalars, or arrays ordered like 'groups' when grouping),
+             'chi2' and 'p-value' if consistency, 'ufloat' if as_ufloat.
+    """
+    nominals = _np.asarray(nominals, dtype=float).ravel()
+    deviations = _np.broadcast_to(_np.asarray(deviations, dtype=float), nominals.shape).ravel()
+    if not _np.all(deviations > 0):
+        raise ValueError("Deviations must be positive")
+    weights = deviations ** -2.
+    if groups is None:
+        inverse = _np.zeros(len(nominals), dtype=int)
+    else:
+        keys, inverse = _np.unique(_np.asarray(groups).ravel(), return_inverse=True)
+        inverse = inverse.ravel()
+    weight_sum = _np.bincount(inverse, weights)
+    mean = _np.bincount(inverse, weights * nominals) / weight_sum
+    res = {'mean': mean, 'sigma': weight_sum ** -0.5}
+    if consistency:
+        counts = _np.bincount(inverse)
+        chi = _np.bincount(inverse, weights * (nominals - mean[inverse]) ** 2)
+        dof = counts - 1
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            res['chi2'] = _np.where(dof > 0, chi / dof, _np.nan)
+        res['p-value'] = _np.where(dof > 0, _stats.chi2.sf(chi, _np.maximum(dof, 1)), _np.nan)
+    if groups is None:
+        res = dict((key, val[0]) for key, val in res.items())
+    else:
+        res['groups'] = keys
+    if as_ufloat:
+        if groups is None:
+            res['ufloat'] = _unc.ufloat(res['mean'], res['sigma'])
         else:
-            nominator.append(result.nominal_value / result.std_dev**2)
-            denominator.append(1 / result.std_dev**2)
-    return _ufloat(sum(nominator) / sum(denominator), 1 / _sqrt(sum(denominator)))
+            res['ufloat'] = _unumpy.uarray(res['mean'], res['sigma'])
+    return res
+
+
+def weighted_mean_frame(frame, nominal, deviation, by=None, consistency=False):
+    """
+    Grouped inverse-variance weighted mean of a dataframe. See weighted_mean.
+    :param frame: A pandas dataframe.
+    :param nominal: Name of the column of measurement results.
+    :param deviation: Name of the column of deviations.
+    :param by: Name of the column to group by, None for a single group.
+    :param consistency: Add 'chi2' and 'p-value' columns.
+    :return: A pandas dataframe indexed by group, with 'mean' and 'sigma' columns.
+    """
+    res = weighted_mean(frame[nominal].to_numpy(), frame[deviation].to_numpy(),
+                        None if by is None else frame[by].to_numpy(), consistency)
+    index = res.pop('groups', [None])
+    columns = ['mean', 'sigma'] + (['chi2', 'p-value'] if consistency else [])
+    return _pd.DataFrame(dict((col, _np.atleast_1d(res[col])) for col in columns),
+                         index=_pd.Index(index, name=by))
+
+
+class Propagation(object):
+    """
+    An equation differentiated once, for evaluating its value and propagated deviation over whole arrays.
+    Get one with error_propagation(), which caches them.
+    """
+
+    def __init__(self, equation, params):
+        """
+        :param equation: A string representing the equation of the measured variable (In python syntax).
+        :param params: A list of the variables in the given equation. Example: ['m', 'r', 'R']
+        """
+        self.params = list(params)
+        self.symbols = _sympy.symbols(self.params)
+        # Map the names explicitly, so variables like E or I aren't read as sympy constants.
+        self.expr = _sympy.sympify(equation, locals=dict(zip(self.params, self.symbols)))
+        self.derivatives = [_sympy.diff(self.expr, par) for par in self.symbols]
+        self._value = _sympy.lambdify(self.symbols, self.expr, 'numpy')
+        self._derivatives = [_sympy.lambdify(self.symbols, der, 'numpy') for der in self.derivatives]
+
+    def _ordered(self, values):
+        if isinstance(values, dict):
+            return [values[par] for par in self.params]
+        return list(values)
+
+    def _arrays(self, values):
+        return _np.broadcast_arrays(*[_np.asarray(val, dtype=float) for val in self._ordered(values)])
+
+    def value(self, values):
+        """
+        :param values: A list of arrays (or a dictionary by name) of nominal values, in the order of params.
+        :return: The equation evaluated over the arrays.
+        """
+        arrays = self._arrays(values)
+        return _np.broadcast_to(self._value(*arrays), arrays[0].shape)
+
+    def jacobian(self, values):
+        """
+        :param values: A list of arrays (or a dictionary by name) of nominal values, in the order of params.
+        :return: An array of the partial derivatives, shaped (len(params),) + values shape.
+        """
+        arrays = self._arrays(values)
+        return _np.stack([_np.broadcast_to(der(*arrays), arrays[0].shape) for der in self._derivatives])
+
+    def error(self, values, deviations=None, cov=None):
+        """
+        Propagated deviation: sqrt(sum((df/dx * dx)^2)), or sqrt(J C J^T) when a covariance matrix is given.
+        :param values: A list of arrays (or a dictionary by name) of nominal values, in the order of params.
+        :param deviations: A list of arrays (or a dictionary by name) of deviations, in the order of params.
+        :param cov: Covariance matrix of the params instead of deviations, shaped (k, k) or (..., k, k).
+        :return: An array of propagated deviations.
+        """
+        if cov is not None:
+            cov = _np.asarray(cov, dtype=float)
+            jac_last = _np.moveaxis(self.jacobian(values), 0, -1)
+            return _np.sqrt(_np.einsum('...i,...ij,...j->...', jac_last, cov, jac_last))
+        if deviations is None:
+            raise ValueError("Either deviations or cov must be given")
+        # Values and deviations broadcast together, so a constant deviation per variable works with arrays.
+        k = len(self.params)
+        arrays = self._arrays(self._ordered(values) + self._ordered(deviations))
+        jac = self.jacobian(arrays[:k])
+        return _np.sqrt(_np.sum((jac * _np.stack(arrays[k:])) ** 2, axis=0))
+
+    def propagate(self, values, deviations=None, cov=None):
+        """
+        :return: A tuple of arrays (value, deviation). See value() and error().
+        """
+        return self.value(values), self.error(values, deviations, cov)
+
+    def latex(self):
+        """
+        :return: The equation of the deviation, as a string. Render nicely with Lab.Display.print_latex
+        """
+        answers = "$\\sqrt{"
+        for par, der in zip(self.symbols, self.derivatives):
+            answers += "((" + str(der) + ")\\Delta " + str(par) + ")^2 +"
+        answers = answers[:-1] + "}$"
+        answers = answers.replace('**', '^')
+        answers = answers.replace('*', '')
+        return answers
+
+
+@_lru_cache(maxsize=128)
+def _cached_propagation(equation, params):
+    return Propagation(equation, params)
+
+
+def error_propagation(equation, params):
+    """
+    Differentiates an equation once (cached by equation and params), for propagating deviations over arrays.
+    Example: error_propagation("m*r**2", ['m', 'r']).propagate([m, r], [dm, dr])
+    :param equation: A string representing the equation of the measured variable (In python syntax).
+    :param params: A list of the variables in the given equation. Example: ['m', 'r', 'R']
+    :return: A Propagation object.
+    """
+    return _cached_propagation(equation, tuple(params))
 
 
 def partial_derivatives(equation, params):
@@ -67,23 +308,126 @@ def partial_derivatives(equation, params):
     :param params: A list of the variables in the given equation. Example: ['m', 'r', 'R']
     :return: A string. Render nicely with Lab.Display.print_latex
     """
-    symbol_params = _symbols(" ".join(params))
-    answers = "$\\sqrt{"
-    for par in symbol_params:
-        answers += "((" + str(_diff(equation, par)) + ")\Delta " + str(par) + ")^2 +"
-    answers = answers[:-1] + "}$"
-    answers = answers.replace('**', '^')
-    answers = answers.replace('*', '')
-    return answers
+    return error_propagation(equation, params).latex()
 
 
 def n_sigma_test(n1, dn1, n2, dn2):
     """
     Preforms an Nsigma test between two different measurements.
+    Works elementwise on arrays too. To compare every measurement with every other one, see n_sigma_matrix.
     :param n1: First measurement result.
     :param dn1: First measurement deviation.
     :param n2: second measurement result.
     :param dn2: second measurement deviation.
     :return: Nsigma test result, Should be smaller the 3.
     """
-    return abs(n1-n2)/_sqrt(dn1**2+dn2**2)
+    try:
+        return abs(n1-n2)/_sqrt(dn1**2+dn2**2)
+    except TypeError:  # Arrays (or lists)
+        return _np.abs(_np.subtract(n1, n2)) / _np.sqrt(_np.square(dn1) + _np.square(dn2))
+
+
+def _values_deviations(values, deviations):
+    """
+    :return: Float arrays of the values and deviations, taken from ufloats if deviations is None.
+    """
+    if deviations is None:
+        values = _np.asarray(values, dtype=object).ravel()
+        return _unumpy.nominal_values(values).astype(float), _unumpy.std_devs(values).astype(float)
+    values = _np.asarray(values, dtype=float).ravel()
+    return values, _np.broadcast_to(_np.asarray(deviations, dtype=float), values.shape).ravel()
+
+
+def n_sigma_matrix(values, deviations=None, others=None, other_deviations=None, dtype=float):
+    """
+    Nsigma test of every measurement against every other one (or against every one of a second set).
+    Needs N*M floats of memory, for large sets see n_sigma_pairs.
+    :param values: An array of measurement results, or of ufloats (then leave deviations None).
+    :param deviations: An array of the measurements deviations.
+    :param others: A second array of results (or ufloats), None to compare values with themselves.
+    :param other_deviations: An array of the second set deviations.
+    :param dtype: Data type of the matrix (Example: numpy.float32 halves the memory).
+    :return: An (N, M) array, element [i, j] is n_sigma_test of values[i] and others[j].
+    """
+    n1, dn1 = _values_deviations(values, deviations)
+    n2, dn2 = (n1, dn1) if others is None else _values_deviations(others, other_deviations)
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        out = _np.subtract.outer(n1.astype(dtype), n2.astype(dtype))
+        _np.abs(out, out=out)
+        out /= _np.sqrt(_np.add.outer(_np.square(dn1).astype(dtype), _np.square(dn2).astype(dtype)))
+    return out
+
+
+def _n_sigma_block(shared, rows):
+    """
+    Finds the inconsistent pairs of a block of rows against all (later, when self-comparing) columns.
+    :param shared: A tuple (n1, dn1 squared, n2, dn2 squared, threshold, block_size, symmetric).
+    :param rows: A (start, stop) tuple of row indices.
+    :return: A list of (i, j, nsigma) arrays, one per column block.
+    """
+    n1, var1, n2, var2, threshold, block_size, symmetric = shared
+    start, stop = rows
+    # Compares diff^2 > threshold^2 * var, no square roots or divisions for the (many) consistent pairs.
+    limit1 = var1[start:stop] * threshold ** 2
+    limit2 = var2 * threshold ** 2
+    diff_buf = _np.empty((stop - start) * block_size)
+    limit_buf = _np.empty_like(diff_buf)
+    found = []
+    for col in range(start if symmetric else 0, len(n2), block_size):
+        shape = (stop - start, min(block_size, len(n2) - col))
+        diff = _np.subtract.outer(n1[start:stop], n2[col:col + block_size], out=diff_buf[:shape[0] * shape[1]]
+                                  .reshape(shape))
+        _np.square(diff, out=diff)
+        limit = _np.add.outer(limit1, limit2[col:col + block_size], out=limit_buf[:shape[0] * shape[1]].reshape(shape))
+        hits = diff > limit
+        if symmetric and col < stop:
+            _np.logical_and(hits, _np.arange(start, stop)[:, None] < _np.arange(col, col + shape[1])[None, :], out=hits)
+        i, j = _np.nonzero(hits)
+        with _np.errstate(divide='ignore'):
+            found.append((i + start, j + col, _np.sqrt(diff[i, j] / (var1[i + start] + var2[j + col]))))
+    return found
+
+
+def iter_n_sigma_pairs(values, deviations=None, threshold=3., others=None, other_deviations=None,
+                       block_size=1024, processes=1):
+    """
+    Blockwise Nsigma screening: yields the inconsistent pairs (Nsigma above threshold) without building the
+    full matrix, using block_size^2 floats of memory per block.
+    :param values: An array of measurement results, or of ufloats (then leave deviations None).
+    :param deviations: An array of the measurements deviations.
+    :param threshold: Report pairs with an Nsigma test result above this.
+    :param others: A second array of results (or ufloats), None to compare values with themselves (each pair
+                   reported once, with i < j).
+    :param other_deviations: An array of the second set deviations.
+    :param block_size: Rows/columns per block.
+    :param processes: Number of worker processes, None for all cores, 1 for serial.
+    :return: A generator of (i, j, nsigma) tuples of arrays, one per block.
+    """
+    n1, dn1 = _values_deviations(values, deviations)
+    n2, dn2 = (n1, dn1) if others is None else _values_deviations(others, other_deviations)
+    shared = (n1, dn1 ** 2, n2, dn2 ** 2, threshold, block_size, others is None)
+    rows = [(start, min(start + block_size, len(n1))) for start in range(0, len(n1), block_size)]
+    if processes == 1:
+        for item in rows:
+            for found in _n_sigma_block(shared, item):
+                yield found
+        return
+    for part in _parallel_map(_n_sigma_block, rows, processes, shared=shared):
+        for found in part:
+            yield found
+
+
+def n_sigma_pairs(values, deviations=None, threshold=3., others=None, other_deviations=None, block_size=1024,
+                  processes=1):
+    """
+    The sparse version of n_sigma_matrix: lists only the inconsistent pairs (Nsigma above threshold).
+    Computed blockwise with bounded memory, so screening tens of thousands of runs is practical.
+    See iter_n_sigma_pairs for the parameters.
+    :return: A pandas dataframe with columns 'i', 'j' (indices of the pair) and 'n_sigma', sorted by i, j.
+    """
+    found = list(iter_n_sigma_pairs(values, deviations, threshold, others, other_deviations, block_size,
+                                    processes))
+    frame = _pd.DataFrame({'i': _np.concatenate([part[0] for part in found] or [_np.empty(0, dtype=int)]),
+                           'j': _np.concatenate([part[1] for part in found] or [_np.empty(0, dtype=int)]),
+                           'n_sigma': _np.concatenate([part[2] for part in found] or [_np.empty(0)])})
+    return frame.sort_values(['i', 'j'], kind='stable').reset_index(drop=True)
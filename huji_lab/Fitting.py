@@ -0,0 +1,234 @@
+import numpy as _np
+import inspect as _inspect
+import weakref as _weakref
+from huji_lab._lazy import LazyModule as _LazyModule
+from huji_lab._parallel import parallel_map as _parallel_map
+from huji_lab._parallel import split_chunks as _split_chunks
+from huji_lab._parallel import cpu_count as _cpu_count
+from huji_lab.Errors import chi_squared as _chi_squared
+from huji_lab.Profiling import instrumented as _instrumented
+from huji_lab.Profiling import stage as _stage
+
+_opt = _LazyModule("scipy.optimize")
+_stats = _LazyModule("scipy.stats")
+_sympy = _LazyModule("sympy")
+
+# Analytic jacobians derived by derive_jacobian, per model function (None when it can't be derived).
+_jacobians = _weakref.WeakKeyDictionary()
+
+
+def _n_params(graph_type):
+    code = getattr(graph_type, '__code__', None)
+    if code is not None and not code.co_flags & 0x0C:  # No *args/**kwargs
+        return code.co_argcount - 1
+    return len(_inspect.signature(graph_type).parameters) - 1
+
+
+# Arbitrary, distinct parameter values of mixed signs and scales for testing linearity. Several points, so models
+# linear only piecewise (Example: lambda x,a,b: abs(a)*x+b) fail at one of them.
+_LINEARITY_PROBES = _np.random.RandomState(0).uniform(-2., 2., (3, 64)) * _np.array([[1.], [10.], [1000.]])
+
+
+def linear_basis(graph_type, x, n_params=None):
+    """
+    Checks (numerically) if a model is linear in its parameters: f(x, p) = f0(x) + sum(p_i * f_i(x)).
+    :param graph_type: Formula of fit. Example: lambda x,a,b: a*x+b.
+    :param x: Horizontal axis data.
+    :param n_params: Number of parameters, None to read it from the signature.
+    :return: A tuple (f0, basis) of arrays shaped (n,) and (k, n), or None for a nonlinear model.
+    """
+    x = _np.asarray(x, dtype=float)
+    k = _n_params(graph_type) if n_params is None else n_params
+    try:
+        with _np.errstate(all='ignore'):
+            offset = _np.broadcast_to(_np.asarray(graph_type(x, *_np.zeros(k)), dtype=float), x.shape)
+            basis = _np.array([graph_type(x, *row) - offset for row in _np.eye(k)], dtype=float).reshape(k, -1)
+            if not (_np.all(_np.isfinite(offset)) and _np.all(_np.isfinite(basis))):
+                return None
+            # Every parameter is also probed alone at -1, so each one is seen with both signs.
+            for probe in _np.vstack((_LINEARITY_PROBES[:, :k], -_np.eye(k))):
+                actual = _np.asarray(graph_type(x, *probe), dtype=float)
+                expected = offset + probe.dot(basis)
+                if not _np.all(_np.abs(actual - expected) <= 1e-8 * (_np.abs(expected) + _np.abs(expected).max() + 1)):
+                    return None
+    except (ArithmeticError, ValueError, TypeError):
+        return None
+    return offset, basis
+
+
+def _svd_inverse(design):
+    """
+    SVD of a design matrix, with the reciprocals of negligible singular values zeroed (the pinv/lstsq rcond cutoff),
+    so rank deficient (over-parameterized) models get the minimal norm solution instead of huge values.
+    :param design: An (n, k) array.
+    :return: A tuple (u, inverse singular values, vt).
+    """
+    u, s, vt = _np.linalg.svd(design, full_matrices=False)
+    cutoff = s.max(initial=0.) * max(design.shape) * _np.finfo(float).eps
+    inverse = _np.zeros_like(s)
+    inverse[s > cutoff] = 1. / s[s > cutoff]
+    return u, inverse, vt
+
+
+def _linear_fit(offset, basis, y, sigma=None, absolute_sigma=False):
+    """
+    Closed form (weighted) least squares, with the same covariance convention (and input errors) as curve_fit.
+    :return: A tuple (popt, pcov).
+    """
+    n, k = len(y), len(basis)
+    if n < k:
+        raise TypeError("Improper input: number of parameters %d must not exceed number of data points %d" % (k, n))
+    if not (_np.all(_np.isfinite(y)) and (sigma is None or _np.all(_np.isfinite(sigma)))):
+        raise ValueError("array must not contain infs or NaNs")
+    design = basis.T
+    target = y - offset
+    if sigma is not None:
+        design = design / sigma[:, None]
+        target = target / sigma
+    u, inverse, vt = _svd_inverse(design)
+    popt = vt.T.dot(u.T.dot(target) * inverse)
+    pcov = (vt.T * inverse ** 2).dot(vt)
+    if not absolute_sigma:
+        dof = len(y) - len(popt)
+        pcov = pcov * (_np.sum((target - design.dot(popt)) ** 2) / dof) if dof > 0 else _np.full_like(pcov, _np.inf)
+    return popt, pcov
+
+
+def derive_jacobian(graph_type):
+    """
+    Derives the analytic jacobian of a model with sympy (cached per function). Works for models written with
+    operators only (Example: lambda x,a,b: a*x**b), not for models calling numpy functions.
+    :param graph_type: Formula of fit. Example: lambda x,a,b: a/(x+b).
+    :return: A function jac(x, *params) returning an (n, k) array, or None if it can't be derived.
+    """
+    try:
+        return _jacobians[graph_type]
+    except (KeyError, TypeError):
+        pass
+    jac = None
+    try:
+        names = list(_inspect.signature(graph_type).parameters)
+        symbols = _sympy.symbols(names)
+        expr = _sympy.sympify(graph_type(*symbols))
+        derivatives = _sympy.lambdify(symbols, [_sympy.diff(expr, par) for par in symbols[1:]], 'numpy')
+
+        def jac(x, *params):
+            x = _np.asarray(x, dtype=float)
+            return _np.column_stack([_np.broadcast_to(der, x.shape) for der in derivatives(x, *params)])
+    except Exception:  # Anything sympy can't trace through, falls back to numerical differentiation.
+        jac = None
+    try:
+        _jacobians[graph_type] = jac
+    except TypeError:
+        pass
+    return jac
+
+
+@_instrumented
+def fit_it(x, y, graph_type, y_error=0, p0=None, weighted=False, jac=None, linear=True):
+    """
+    Fits a function to two 1D arrays, without plotting anything. Same fit as graph_it.
+    Models linear in their parameters (Example: lambda x,a,b: a*x+b) are solved in closed form.
+    :param x: Horizontal axis data.
+    :param y: Vertical axis data.
+    :param graph_type: Formula of fit. Example: lambda x,a,b: a*x+b.
+    :param y_error: Y Error bar size, used for the chi squared calculation (and as weights if weighted).
+    :param p0: Initial guess of the parameters, None for all ones. Not needed for linear models.
+    :param weighted: Weight the fit by 1/y_error^2, with y_error taken as absolute (pcov is not rescaled).
+    :param jac: Jacobian of a nonlinear model, jac(x, *params) -> (n, k) array. 'auto' derives it with sympy.
+    :param linear: Detect models linear in their parameters and solve them in closed form.
+    :return: A dictionary with 'popt', 'pcov', 'chi2' and 'p-value' (chi2 and p-value are nan without y_error).
+    """
+    x = _np.asarray(x)
+    y = _np.asarray(y)
+    y_error = _np.asarray(y_error)
+    sigma = None
+    if weighted and y_error.any():
+        sigma = _np.broadcast_to(y_error, y.shape).astype(float)
+    with _stage('linear_basis'):
+        basis = linear_basis(graph_type, x) if linear else None
+    if basis is not None:
+        with _stage('linear_fit'):
+            popt, pcov = _linear_fit(basis[0], basis[1], y, sigma, absolute_sigma=sigma is not None)
+    else:
+        if jac == 'auto':
+            with _stage('derive_jacobian'):
+                jac = derive_jacobian(graph_type)
+        with _stage('curve_fit'):
+            popt, pcov = _opt.curve_fit(graph_type, x, y, p0=p0, sigma=sigma, absolute_sigma=sigma is not None,
+                                        jac=jac, maxfev=100000)
+    chi = _np.nan
+    p_value = _np.nan
+    if y_error.any():
+        with _stage('chi_squared'):
+            chi = _chi_squared(x, y, popt, y_error, graph_type)
+            p_value = 1 - _stats.chi2.cdf(chi, 1)
+    return {'popt': popt, 'pcov': pcov, 'chi2': chi, 'p-value': p_value}
+
+
+def _fit_chunk(graph_type, chunk):
+    """
+    Fits a contiguous chunk of datasets in one worker.
+    :param graph_type: Formula of fit (shared with the worker).
+    :param chunk: A tuple of (datasets, initial guesses, warm_start, fit_it keyword arguments).
+    :return: A list of fit_it results, None for failed fits.
+    """
+    datasets, guesses, warm_start, options = chunk
+    results = []
+    previous = None
+    for (x, y, y_error), p0 in zip(datasets, guesses):
+        if warm_start and previous is not None:
+            p0 = previous
+        try:
+            res = fit_it(x, y, graph_type, y_error, p0, **options)
+        except (RuntimeError, ValueError, TypeError):  # TypeError: curve_fit with fewer points than parameters
+            res = None
+        else:
+            previous = res['popt']
+        results.append(res)
+    return results
+
+
+@_instrumented
+def fit_many(datasets, graph_type, p0=None, warm_start=False, processes=None, weighted=False, jac=None,
+             linear=True):
+    """
+    Fits the same function to a stack of datasets across a process pool, without creating any figures.
+    Each fit gives the same numbers as graph_it on that dataset.
+    :param datasets: An iterable of (x, y) or (x, y, y_error) tuples, datasets may differ in length.
+    :param graph_type: Formula of fit. Example: lambda x,a,b: a*x+b.
+    :param p0: Initial guess. None, one guess for all datasets, or a 2D array with a guess per dataset
+               (Example: the 'popt' of a previous run).
+    :param warm_start: Start each fit from the parameters of the previous dataset (within each worker).
+    :param processes: Number of worker processes, None for all cores, 1 for serial.
+    :param weighted: Weight the fits by 1/y_error^2. See fit_it.
+    :param jac: Jacobian of a nonlinear model, or 'auto'. See fit_it.
+    :param linear: Solve models linear in their parameters in closed form. See fit_it.
+    :return: A dictionary of numpy arrays: 'popt' (n, k), 'pcov' (n, k, k), 'chi2' (n,), 'p-value' (n,)
+             and 'success' (n,). Failed fits are filled with nan.
+    """
+    datasets = [(d[0], d[1], d[2] if len(d) > 2 else 0) for d in datasets]
+    n = len(datasets)
+    k = _n_params(graph_type)
+    if p0 is None:
+        guesses = [None] * n
+    else:
+        p0 = _np.asarray(p0, dtype=float)
+        guesses = list(p0) if p0.ndim == 2 else [p0] * n
+
+    indices = _split_chunks(list(range(n)), _cpu_count(processes))
+    options = {'weighted': weighted, 'jac': jac, 'linear': linear}
+    chunks = [([datasets[i] for i in idx], [guesses[i] for i in idx], warm_start, options) for idx in indices]
+    with _stage('fit'):
+        results = [res for part in _parallel_map(_fit_chunk, chunks, processes, shared=graph_type) for res in part]
+
+    out = {'popt': _np.full((n, k), _np.nan), 'pcov': _np.full((n, k, k), _np.nan),
+           'chi2': _np.full(n, _np.nan), 'p-value': _np.full(n, _np.nan), 'success': _np.zeros(n, dtype=bool)}
+    for i, res in enumerate(results):
+        if res is not None:
+            out['popt'][i] = res['popt']
+            out['pcov'][i] = res['pcov']
+            out['chi2'][i] = res['chi2']
+            out['p-value'][i] = res['p-value']
+            out['success'][i] = True
+    return out
@@ -1,23 +1,110 @@
-import pandas as _pd
-import matplotlib.pyplot as _plt
 import numpy as _np
-import seaborn as _sns
-from scipy.optimize import curve_fit as _curve_fit
-from uncertainties import ufloat as _ufloat
-import mplcursors as _mplcursors
-from IPython import display as _dynamicdis
 import time as _time
+import os as _os
+import io as _io
+from huji_lab._lazy import LazyModule as _LazyModule
 from huji_lab.Generators import expand_linspace as _expand_linspace
-from huji_lab.Errors import chi_squared as _chi_squared
-from scipy.stats import chi2 as _chi2
+from huji_lab.Fitting import fit_it as _fit_it
+from huji_lab.DataProc import decimate as _decimate
+from huji_lab.Loaders import load_columns as _load_columns
+from huji_lab.Profiling import instrumented as _instrumented
+from huji_lab.Profiling import stage as _stage
 
+_pd = _LazyModule("pandas")
+_plt = _LazyModule("matplotlib.pyplot")
+_sns = _LazyModule("seaborn")
+_unc = _LazyModule("uncertainties")
+_mplcursors = _LazyModule("mplcursors")
+_dynamicdis = _LazyModule("IPython.display")
+_ticker = _LazyModule("matplotlib.ticker")
 
+_style_applied = False
+
+
+def _apply_style():
+    """
+    Applies the package's seaborn styling, once, on the first plot (instead of on "import huji_lab").
+    :return: None.
+    """
+    global _style_applied
+    if not _style_applied:
+        _sns.set(font_scale=2)
+        _sns.set_style("whitegrid")
+        _style_applied = True
+
+
+_NON_INTERACTIVE_BACKENDS = ('agg', 'pdf', 'ps', 'svg', 'pgf', 'cairo', 'template')
+# Bytes at each end of the already read part of a tailed csv file, compared to detect edits of earlier rows.
+_FINGERPRINT_BYTES = 4096
+
+
+def _is_interactive():
+    """
+    :return: False for headless (file-only) matplotlib backends, where hover cursors are pure overhead.
+    """
+    return _plt.get_backend().lower() not in _NON_INTERACTIVE_BACKENDS
+
+
+def _take(values, shown, length):
+    """
+    Selects the shown points from an error bar size, which is either a scalar or per point.
+    """
+    if values.ndim and values.shape[-1] == length:
+        return values[..., shown]
+    return values
+
+
+def _figure(reuse, key, size):
+    """
+    Returns a figure and axes to draw on, and the artists to update in place: those of a previous graph_it result
+    (anything else drawn on its axes, like hover error bars or extra_code plots, is removed), or a new one.
+    :return: A tuple (fig, ax, artists), artists is a dictionary by role ('model', 'scatter', ...).
+    """
+    if reuse is None or key not in reuse:
+        fig, ax = _plt.subplots(figsize=size)
+        return fig, ax, {}
+    fig, ax = reuse[key]
+    artists = dict((role, artist) for role, artist in reuse.get('artists', {}).get(key, {}).items()
+                   if artist.axes is ax)  # Not removed since (by a later call reusing the same figure)
+    keep = set(id(artist) for artist in artists.values())
+    for artist in list(ax.lines) + list(ax.collections) + list(ax.texts) + list(ax.patches) + list(ax.images):
+        if id(artist) not in keep:
+            artist.remove()
+    del ax.containers[:]
+    if ax.get_legend() is not None:
+        ax.get_legend().remove()
+    ax.xaxis.set_major_locator(_ticker.AutoLocator())  # In case a previous x_scale/y_scale set fixed ticks
+    ax.xaxis.set_major_formatter(_ticker.ScalarFormatter())
+    ax.yaxis.set_major_locator(_ticker.AutoLocator())
+    ax.yaxis.set_major_formatter(_ticker.ScalarFormatter())
+    _plt.figure(fig.number)
+    _plt.sca(ax)
+    return fig, ax, artists
+
+
+def _autoscale(ax, artists):
+    """
+    Recomputes the data limits after artists were updated in place (relim ignores collections, like scatter).
+    """
+    ax.relim()
+    for artist in artists:
+        if hasattr(artist, 'get_offsets') and len(artist.get_offsets()):
+            ax.update_datalim(artist.get_offsets())
+        elif hasattr(artist, 'get_paths'):
+            for path in artist.get_paths():
+                ax.update_datalim(path.vertices)
+    ax.autoscale_view()
+
+
+@_instrumented
 def graph_it(x, y, graph_type=None, x_error=0, y_error=0,
              title="", x_title="", y_title="", size=(20, 10),
              sig_digi=3, coeff_x=0.8, coeff_y=0.8,
              error_fill_bet=True, plot_residuals=True, show_chi=True, coeff_text=(''),
              resid_x_error=0, resid_y_error=0, y_scale="", x_scale="",
-             extra_code_main='', extra_code_residuals=''):
+             extra_code_main='', extra_code_residuals='',
+             max_points=None, rasterized=None, interactive=None, reuse=None,
+             weighted=False, jac=None):
     """
     Plot and Customize two 1D arrays.
     :param x: Horizontal axis data.
@@ -44,51 +131,110 @@ def graph_it(x, y, graph_type=None, x_error=0, y_error=0,
                     most commonly use with generatePiAxis().
     :param extra_code_main: Runs extra script after the main graph plot.
     :param extra_code_residuals: uns extra script after the residuals graph plot.
+    :param max_points: Draw at most this many points (min/max decimation), the fit still uses all of them.
+    :param rasterized: Rasterize the dense layers (points, error bars, error aura). Default: above 5000 points.
+    :param interactive: Install the hover cursor. Default: only on interactive (non file-only) backends.
+    :param reuse: A previous graph_it result, its figures and artists (points, model, error aura, parameters box)
+                  are updated in place instead of creating new ones.
+    :param weighted: Weight the fit by 1/y_error^2 (y_error taken as absolute).
+    :param jac: Jacobian of a nonlinear graph_type, jac(x, *params) -> (n, k) array. 'auto' derives it with sympy.
     :return: A list of guessed parameters given in graph_type.
     """
-    _plt.rc('text', usetex=False)
-    fig, ax = _plt.subplots(figsize=size)
+    with _stage('figure'):
+        _apply_style()
+        _plt.rc('text', usetex=False)
+        fig, ax, reused = _figure(reuse, 'main_graph', size)
+    artists = {}
     tick_fine = 0
-    x = _np.array(x)
-    y = _np.array(y)
-    x_error = _np.array(x_error)
-    y_error = _np.array(y_error)
+    x = _np.asarray(x)
+    y = _np.asarray(y)
+    x_error = _np.asarray(x_error)
+    y_error = _np.asarray(y_error)
     graph_dict = {}
+    n_model = len(x) * 3
+    shown = slice(None)
+    if max_points is not None and len(x) > max_points:
+        with _stage('decimate'):
+            shown = _decimate(x, y, max_points)
+        n_model = max_points * 3
+    n_shown = len(x[shown])
+    if rasterized is None:
+        rasterized = n_shown > 5000
+    if interactive is None:
+        interactive = _is_interactive()
 
     if graph_type is not None:
-        popt, pcov = _curve_fit(graph_type, x, y, maxfev=100000)
+        with _stage('fit'):
+            fit = _fit_it(x, y, graph_type, y_error, weighted=weighted, jac=jac)
+        popt, pcov = fit['popt'], fit['pcov']
         sigma_ab = _np.sqrt(_np.diagonal(pcov))  # type: _np.ndarray
-        x_model = _expand_linspace(x.min(), x.max(), len(x) * 3)
-        _plt.plot(x_model, graph_type(x_model, *popt), 'black')
-        _plt.errorbar(x, y, xerr=x_error, yerr=y_error, fmt='s', color='b', visible=False, alpha=0.6,
-                      capsize=10, capthick=0.5, ecolor='k')
+        with _stage('model'):
+            x_model = _expand_linspace(x.min(), x.max(), n_model)
+            y_model = _np.broadcast_to(graph_type(x_model, *popt), x_model.shape)
+            if 'model' in reused:
+                reused['model'].set_data(x_model, y_model)
+                artists['model'] = reused['model']
+            else:
+                artists['model'] = _plt.plot(x_model, y_model, 'black')[0]
+        if interactive:
+            # Invisible, only there for the hover cursor.
+            with _stage('errorbar'):
+                _plt.errorbar(x[shown], y[shown], xerr=_take(x_error, shown, len(x)),
+                              yerr=_take(y_error, shown, len(x)), fmt='s', color='b', visible=False, alpha=0.6,
+                              capsize=10, capthick=0.5, ecolor='k', rasterized=rasterized)
         if show_chi == True:
             if y_error.any() == 0:
                 print("No stat. error data provided, skipping chi squared calculation")
             else:
-                chi = _chi_squared(x, y, popt, y_error, graph_type)
+                chi = fit['chi2']
                 title += "\n$\\chi^2 = %s$" %str(chi)
                 graph_dict['chi2'] = chi
-                graph_dict['p-value'] = 1 - _chi2.cdf(chi,1)
+                graph_dict['p-value'] = fit['p-value']
         if error_fill_bet:
-            bound_upper = graph_type(x_model, *(popt + sigma_ab))
-            bound_lower = graph_type(x_model, *(popt - sigma_ab))
-            # plotting the confidence intervals
-            _plt.fill_between(x_model, bound_lower, bound_upper, color='midnightblue', alpha=0.15)
+            with _stage('fill_between'):
+                bound_upper = graph_type(x_model, *(popt + sigma_ab))
+                bound_lower = graph_type(x_model, *(popt - sigma_ab))
+                # plotting the confidence intervals
+                if 'fill' in reused and hasattr(reused['fill'], 'set_data'):
+                    reused['fill'].set_data(x_model, bound_lower, bound_upper)
+                    reused['fill'].set_rasterized(rasterized)
+                    artists['fill'] = reused['fill']
+                else:
+                    if 'fill' in reused:
+                        reused['fill'].remove()
+                    artists['fill'] = _plt.fill_between(x_model, bound_lower, bound_upper, color='midnightblue',
+                                                        alpha=0.15, rasterized=rasterized)
         if coeff_text != ():
             coeff_text = list(coeff_text)
             coeff_text += [''] * (len(popt) - len(coeff_text))
             text_res = ""
             for i, param in enumerate(popt):
                 text_res += ((graph_type.__code__.co_varnames[i + 1]) +
-                             str((" = {:." + str(sig_digi) + "u}").format(_ufloat(popt[i], sigma_ab[i])) +
+                             str((" = {:." + str(sig_digi) + "u}").format(_unc.ufloat(popt[i], sigma_ab[i])) +
                                  coeff_text[i] + "\n"))
-            _plt.text(coeff_x, coeff_y, text_res[:-2], transform=ax.transAxes, fontsize=20,
-                      bbox=dict(boxstyle='round', facecolor='grey', alpha=0.5),
-                      family='DejaVu Sans')
+            if 'text' in reused:
+                reused['text'].set_text(text_res[:-2])
+                reused['text'].set_position((coeff_x, coeff_y))
+                artists['text'] = reused['text']
+            else:
+                artists['text'] = _plt.text(coeff_x, coeff_y, text_res[:-2], transform=ax.transAxes, fontsize=20,
+                                            bbox=dict(boxstyle='round', facecolor='grey', alpha=0.5),
+                                            family='DejaVu Sans')
         tick_fine = 1
 
-    _plt.scatter(x, y, facecolor='red', marker='s',edgecolor='black', s=70, alpha=1)
+    with _stage('scatter'):
+        if 'scatter' in reused:
+            reused['scatter'].set_offsets(_np.column_stack((x[shown], y[shown])))
+            reused['scatter'].set_rasterized(rasterized)
+            artists['scatter'] = reused['scatter']
+        else:
+            artists['scatter'] = _plt.scatter(x[shown], y[shown], facecolor='red', marker='s',edgecolor='black',
+                                              s=70, alpha=1, rasterized=rasterized)
+    for role, artist in reused.items():  # Parts not drawn this time (Example: no fit)
+        if role not in artists:
+            artist.remove()
+    if reused:
+        _autoscale(ax, artists.values())
     _sns.set_style("whitegrid")
     ax.set_title(title)
     ax.set_ylabel(y_title)
@@ -108,47 +254,162 @@ def graph_it(x, y, graph_type=None, x_error=0, y_error=0,
     if tick_fine == 1:
         ax.set_xlim(x_model.min(), x_model.max())
     else:
-        ax.set_xlim(_expand_linspace(x.min(), x.max(),len(x) * 3).min(),_expand_linspace(x.min(), x.max(),len(x) * 3).max())
-    exec(extra_code_main)
+        ax.set_xlim(_expand_linspace(x.min(), x.max(), n_model).min(), _expand_linspace(x.min(), x.max(), n_model).max())
+    with _stage('extra_code_main'):
+        exec(extra_code_main)
     graph_dict['main_graph'] = (fig, ax)
+    graph_dict['artists'] = {'main_graph': artists}
 
     if plot_residuals and graph_type is not None:
-        residuals = y - graph_type(x, *popt)
-        fig, ax = _plt.subplots(figsize=(20, 5))
-        _plt.scatter(x, residuals, facecolor='red', marker='s', edgecolor='black', s=70, alpha=1)
-        ax.errorbar(x, residuals, xerr=resid_x_error, fmt='s', yerr=residuals * resid_y_error, marker='s',
-                    visible=False, alpha=0.6, capsize=10, capthick=0.5, ecolor='k')
-        ax.set_xlim(x_model.min(), x_model.max())
-        ax.set_ylim(residuals.min() - _np.abs(residuals.min()*0.5), residuals.max() + _np.abs(residuals.max()*0.5))
-        ax.set_title("Residuals Plot of " + title)
-        ax.set_ylabel(y_title)
-        ax.set_xlabel(x_title)
+        with _stage('residuals'):
+            residuals = y - graph_type(x, *popt)
+            fig, ax, reused = _figure(reuse, 'resid_graph', (20, 5))
+            resid_shown = shown
+            if max_points is not None and len(x) > max_points:
+                resid_shown = _decimate(x, residuals, max_points)
+            if 'scatter' in reused:
+                reused['scatter'].set_offsets(_np.column_stack((x[resid_shown], residuals[resid_shown])))
+                reused['scatter'].set_rasterized(rasterized)
+                resid_scatter = reused['scatter']
+            else:
+                resid_scatter = _plt.scatter(x[resid_shown], residuals[resid_shown], facecolor='red', marker='s',
+                                             edgecolor='black', s=70, alpha=1, rasterized=rasterized)
+            graph_dict['artists']['resid_graph'] = {'scatter': resid_scatter}
+            if interactive:
+                resid_x_error = _np.asarray(resid_x_error)
+                resid_y_error = _np.asarray(resid_y_error)
+                ax.errorbar(x[resid_shown], residuals[resid_shown], xerr=_take(resid_x_error, resid_shown, len(x)),
+                            fmt='s', yerr=residuals[resid_shown] * _take(resid_y_error, resid_shown, len(x)),
+                            marker='s', visible=False, alpha=0.6, capsize=10, capthick=0.5, ecolor='k',
+                            rasterized=rasterized)
+            ax.set_xlim(x_model.min(), x_model.max())
+            ax.set_ylim(residuals.min() - _np.abs(residuals.min()*0.5), residuals.max() + _np.abs(residuals.max()*0.5))
+            ax.set_title("Residuals Plot of " + title)
+            ax.set_ylabel(y_title)
+            ax.set_xlabel(x_title)
         graph_dict['resid_graph'] = (fig, ax)
-    _mplcursors.cursor(hover=True)
+    if reuse is not None and reuse.get('cursor') is not None:
+        reuse['cursor'].remove()
+    if interactive:
+        with _stage('cursor'):
+            graph_dict['cursor'] = _mplcursors.cursor(hover=True)
 
-    exec(extra_code_residuals)
+    with _stage('extra_code_residuals'):
+        exec(extra_code_residuals)
     if tick_fine == 1:
-        graph_dict['params'] = [(_ufloat(popt[i], sigma_ab[i])) for i in range(len(popt))]
+        graph_dict['params'] = [(_unc.ufloat(popt[i], sigma_ab[i])) for i in range(len(popt))]
         return graph_dict
     else:
         return graph_dict
 
 
-def dynamic_draw(path, refresh_time=1, sheet='Sheet1'):
+def _file_stamp(path):
+    """
+    :param path: Path to a file.
+    :return: (mtime, size) of the file, or None if it doesn't exist (yet).
+    """
+    try:
+        stat = _os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_csv_tail(path, state):
+    """
+    Reads only the rows appended to a csv file since the previous call (the first call reads it all).
+    Incomplete last lines are left for the next call. The file is re-read from the start when it was replaced or got
+    shorter, or when the first or last already read _FINGERPRINT_BYTES bytes changed (earlier rows were edited).
+    :param path: Path to the csv file, first line is a header.
+    :param state: A dictionary kept between calls, start with {}.
+    :return: A tuple (x, y, reset), reset is True when the rows replace (rather than extend) earlier ones.
+    """
+    offset = state.get('offset', 0)
+    with open(path, 'rb') as fh:
+        inode = _os.fstat(fh.fileno()).st_ino
+        if offset:
+            head = fh.read(len(state['head']))
+            fh.seek(max(offset - len(state['tail']), 0))
+            tail = fh.read(len(state['tail']))
+            if inode != state['inode'] or head != state['head'] or tail != state['tail']:
+                offset = 0
+        fh.seek(offset)
+        chunk = fh.read()
+    complete = chunk[:chunk.rfind(b'\n') + 1]
+    reset = offset == 0
+    if reset:
+        state['head'] = complete[:_FINGERPRINT_BYTES]
+        state['tail'] = b''
+    state['tail'] = (state['tail'] + complete[-_FINGERPRINT_BYTES:])[-_FINGERPRINT_BYTES:]
+    state['offset'] = offset + len(complete)
+    state['inode'] = inode
+    if reset:
+        complete = complete[complete.find(b'\n') + 1:]  # header line
+    if not complete.strip():
+        return _np.empty(0), _np.empty(0), reset
+    tempdf = _pd.read_csv(_io.BytesIO(complete), header=None, usecols=[0, 1])
+    return tempdf.iloc[:, 0].to_numpy(dtype=float), tempdf.iloc[:, 1].to_numpy(dtype=float), reset
+
+
+def dynamic_draw(path, refresh_time=1, sheet='Sheet1', window=None, max_updates=None, dtype=float):
     """
-    Dynamically plots a 2D array, read from an XLS or XLSX file (Save the file == Refresh the graph).
-    :param path: Full path to the csv file.
-    :param refresh_time: Seconds between graph redraw
-    :param sheet:   Defaults to Sheet1, change accordingly.
+    Dynamically plots a 2D array, read from a CSV, XLS, XLSX, NPY or raw binary file (Save the file == Refresh the
+    graph). The graph is redrawn only when the file changes. CSV files are tailed, so only appended rows are read.
+    NPY and raw binary (.bin, .dat, .raw, two interleaved columns) files are memory mapped, so with a window only
+    the shown rows are read.
+    :param path: Full path to the csv/excel/npy/binary file.
+    :param refresh_time: Seconds between checks for a change in the file.
+    :param sheet:   Defaults to Sheet1, change accordingly. Ignored for csv files.
+    :param window: Show only the last "window" points, None for all of them.
+    :param max_updates: Stop after this many redraws, None to run until interrupted.
+    :param dtype: Data type of a raw binary file.
     :return: None.
     """
+    _apply_style()
     fig, ax = _plt.subplots(figsize=(20, 10))
-    while True:
+    scatter = ax.scatter([], [], s=100)
+    x = _np.empty(0)
+    y = _np.empty(0)
+    extension = _os.path.splitext(str(path))[1].lower()
+    is_csv = extension == '.csv'
+    is_binary = extension in ('.npy', '.bin', '.dat', '.raw')
+    tail_state = {}
+    last_stamp = None
+    updates = 0
+    while max_updates is None or updates < max_updates:
         try:
-            tempdf = _pd.read_excel(path, sheet_name=sheet)
-            _sns.regplot(x=tempdf.iloc[:, 0], y=tempdf.iloc[:, 1], fit_reg=False, ax=ax, scatter_kws={"s": 100})
-            _dynamicdis.display(_plt.gcf())
-            _dynamicdis.clear_output(wait=True)
+            stamp = _file_stamp(path)
+            if stamp is not None and stamp != last_stamp:
+                last_stamp = stamp
+                if is_csv:
+                    try:
+                        new_x, new_y, reset = _read_csv_tail(path, tail_state)
+                    except ValueError:
+                        # Caught mid save, or rows that don't parse: read the whole file again once it changes.
+                        tail_state.clear()
+                        _time.sleep(refresh_time)
+                        continue
+                elif is_binary:
+                    new_x, new_y = _load_columns(path, dtype)
+                    reset = True
+                else:
+                    tempdf = _pd.read_excel(path, sheet_name=sheet)
+                    new_x, new_y = tempdf.iloc[:, 0].to_numpy(dtype=float), tempdf.iloc[:, 1].to_numpy(dtype=float)
+                    reset = True
+                if reset:
+                    x, y = new_x, new_y
+                else:
+                    x, y = _np.concatenate((x, new_x)), _np.concatenate((y, new_y))
+                if window is not None:
+                    x, y = x[-window:], y[-window:]
+                scatter.set_offsets(_np.column_stack((x, y)))
+                if len(x):
+                    ax.set_xlim(_expand_linspace(x.min(), x.max(), 2)[[0, -1]])
+                    y_pad = (y.max() - y.min()) * 0.05 or 1
+                    ax.set_ylim(y.min() - y_pad, y.max() + y_pad)
+                _dynamicdis.display(fig)
+                _dynamicdis.clear_output(wait=True)
+                updates += 1
             _time.sleep(refresh_time)
         except KeyboardInterrupt:
             break
@@ -0,0 +1,111 @@
+import numpy as _np
+import os as _os
+from huji_lab._lazy import LazyModule as _LazyModule
+
+_pd = _LazyModule("pandas")
+
+CHUNK_ROWS = 2 ** 20
+
+
+def load_array(path, dtype=float, columns=None, offset=0, mode='r'):
+    """
+    Opens a .npy or a raw binary file as a memory mapped array, without reading it into memory.
+    Pages are read from disk only when accessed, so slices and column views of multi-GB files are cheap.
+    :param path: Path to a .npy file, or to a raw binary file (headerless, C order).
+    :param dtype: Data type of a raw binary file. Ignored for .npy files.
+    :param columns: Number of columns of a raw binary file (interleaved samples), None for a 1D array.
+    :param offset: Bytes to skip at the start of a raw binary file (a header).
+    :param mode: 'r' for read only, 'r+' to write through to the file, 'c' for copy on write.
+    :return: A numpy memmap.
+    """
+    if str(path).lower().endswith('.npy'):
+        return _np.load(path, mmap_mode=mode)
+    dtype = _np.dtype(dtype)
+    rows = (_os.path.getsize(path) - offset) // (dtype.itemsize * (columns or 1))
+    shape = (rows,) if columns is None else (rows, columns)
+    return _np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+
+def load_columns(path, dtype=float, columns=2, offset=0, x_column=0, y_column=1):
+    """
+    Memory maps a 2D .npy or raw binary file and returns its x and y columns, as views (no copy).
+    :param path: Path to a .npy file, or to a raw binary file (headerless, C order).
+    :param dtype: Data type of a raw binary file. Ignored for .npy files.
+    :param columns: Number of columns of a raw binary file. Ignored for .npy files.
+    :param offset: Bytes to skip at the start of a raw binary file.
+    :param x_column: Index of the x column.
+    :param y_column: Index of the y column.
+    :return: A tuple (x, y) of 1D memmap views.
+    """
+    data = load_array(path, dtype, columns, offset)
+    return data[:, x_column], data[:, y_column]
+
+
+def iter_chunks(x, y, chunk_rows=CHUNK_ROWS):
+    """
+    Splits (x, y) arrays (Example: memory mapped ones) to consecutive (x, y) views.
+    Feed the result to DataProc.detect_extrema_stream.
+    :param x: A 1D array.
+    :param y: A 1D array.
+    :param chunk_rows: Number of rows per chunk.
+    :return: A generator of (x, y) pairs of 1D views.
+    """
+    for start in range(0, len(y), chunk_rows):
+        yield x[start:start + chunk_rows], y[start:start + chunk_rows]
+
+
+def iter_csv(path, chunk_rows=CHUNK_ROWS, usecols=(0, 1), dtype=float, **read_csv_kwargs):
+    """
+    Reads a large csv file in chunks of rows, holding one chunk in memory at a time.
+    :param path: Path to the csv file.
+    :param chunk_rows: Number of rows per chunk.
+    :param usecols: The columns to read, by index or name.
+    :param dtype: Data type of the returned arrays.
+    :param read_csv_kwargs: Passed to pandas.read_csv (Example: sep='\t', header=None).
+    :return: A generator, yielding a tuple of 1D arrays (one per column in usecols) per chunk.
+    """
+    usecols = list(usecols)
+    by_index = all(isinstance(col, int) for col in usecols)
+    positions = _np.argsort(_np.argsort(usecols)) if by_index else None  # read_csv keeps the file's column order
+    with _pd.read_csv(path, usecols=usecols, chunksize=chunk_rows, **read_csv_kwargs) as reader:
+        for frame in reader:
+            frame = frame.iloc[:, positions] if by_index else frame[usecols]
+            yield tuple(frame.iloc[:, i].to_numpy(dtype=dtype) for i in range(len(usecols)))
+
+
+def _count_rows(path, skip):
+    """
+    :return: The number of lines in a text file, minus "skip" header lines.
+    """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(2 ** 24), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n') - skip
+
+
+def csv_to_npy(path, npy_path=None, chunk_rows=CHUNK_ROWS, usecols=(0, 1), dtype=float, **read_csv_kwargs):
+    """
+    Converts a large csv file to a .npy file, chunk by chunk, for fast memory mapped access with load_array.
+    :param path: Path to the csv file.
+    :param npy_path: Path of the .npy file, defaults to the csv path with a .npy extension.
+    :param chunk_rows: Number of rows per chunk.
+    :param usecols: The columns to keep, by index or name.
+    :param dtype: Data type of the .npy file.
+    :param read_csv_kwargs: Passed to pandas.read_csv.
+    :return: A read only memmap of the (rows, len(usecols)) .npy file.
+    """
+    if npy_path is None:
+        npy_path = _os.path.splitext(str(path))[0] + '.npy'
+    header = read_csv_kwargs.get('header', 'infer')
+    skip = 1 if header == 'infer' else 0 if header is None else header + 1
+    out = _np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(_count_rows(path, skip), len(usecols)))
+    row = 0
+    for columns in iter_csv(path, chunk_rows, usecols, dtype, **read_csv_kwargs):
+        out[row:row + len(columns[0])] = _np.column_stack(columns)
+        row += len(columns[0])
+    out.flush()
+    del out
+    return load_array(npy_path)[:row]  # blank lines are counted but not read
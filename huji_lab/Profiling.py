@@ -0,0 +1,156 @@
+import time as _time
+import json as _json
+import itertools as _itertools
+import functools as _functools
+from huji_lab._lazy import LazyModule as _LazyModule
+
+_pd = _LazyModule("pandas")
+
+# Active profilers (innermost last) and the stack of instrumented calls in progress.
+_profilers = []
+_calls = []
+_call_ids = _itertools.count()
+
+
+class _Null(object):
+    """
+    Shared do-nothing context manager, returned while no profiler is active (keeps the overhead near zero).
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL = _Null()
+
+
+def _emit(record):
+    for profiler in _profilers:
+        profiler.add(record)
+
+
+class _Call(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.call_id = next(_call_ids)
+        self.parent_id = _calls[-1].call_id if _calls else None
+        _calls.append(self)
+        self.start = _time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = _time.perf_counter() - self.start
+        _calls.pop()
+        _emit({'call': self.name, 'call_id': self.call_id, 'parent_id': self.parent_id, 'stage': 'total',
+               'seconds': elapsed})
+        return False
+
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = _time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = _time.perf_counter() - self.start
+        current = _calls[-1] if _calls else None
+        _emit({'call': current.name if current else None, 'call_id': current.call_id if current else None,
+               'parent_id': current.parent_id if current else None, 'stage': self.name, 'seconds': elapsed})
+        return False
+
+
+def call(name):
+    """
+    Marks an instrumented call (Example: graph_it). Used as "with call('graph_it'):".
+    :param name: Name of the function.
+    :return: A context manager, a no-op one when no Profiler is active.
+    """
+    return _Call(name) if _profilers else _NULL
+
+
+def instrumented(func):
+    """
+    Decorator, marks every call of the function as an instrumented call (see call()).
+    """
+    name = func.__name__
+
+    @_functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profilers:
+            return func(*args, **kwargs)
+        with _Call(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def stage(name):
+    """
+    Marks a stage of the current instrumented call. Used as "with stage('curve_fit'):".
+    :param name: Name of the stage.
+    :return: A context manager, a no-op one when no Profiler is active.
+    """
+    return _Stage(name) if _profilers else _NULL
+
+
+class Profiler(object):
+    """
+    Collects per-stage timings of graph_it, fit_it, fit_sin and the peak detection functions.
+    Example:
+        with Profiler() as prof:
+            graph_it(x, y, lambda x,a,b: a*x+b)
+        prof.summary()
+    Stages running in worker processes (fit_many, fit_sin_many) are only timed as a whole.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: Optional function, called with each record (a dictionary) as it is collected.
+        """
+        self.records = []
+        self.callback = callback
+
+    def __enter__(self):
+        _profilers.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _profilers.remove(self)
+        return False
+
+    def add(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_frame(self):
+        """
+        :return: A pandas dataframe, one row per record: call, call_id, parent_id, stage, seconds.
+        """
+        return _pd.DataFrame(self.records, columns=['call', 'call_id', 'parent_id', 'stage', 'seconds'])
+
+    def to_json(self, path=None):
+        """
+        :param path: File to write to, None to only return the string.
+        :return: The records as a JSON string.
+        """
+        text = _json.dumps(self.records)
+        if path is not None:
+            with open(path, 'w') as fh:
+                fh.write(text)
+        return text
+
+    def summary(self):
+        """
+        :return: A pandas dataframe of call counts and total/mean seconds per (call, stage).
+        """
+        frame = self.to_frame()
+        return frame.groupby(['call', 'stage'])['seconds'].agg(['count', 'sum', 'mean']).rename(
+            columns={'sum': 'total'}).sort_values('total', ascending=False)
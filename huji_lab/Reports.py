@@ -0,0 +1,165 @@
+import os as _os
+import json as _json
+import hashlib as _hashlib
+import types as _types
+import numpy as _np
+from huji_lab._lazy import LazyModule as _LazyModule
+from huji_lab._parallel import parallel_map as _parallel_map
+
+_pd = _LazyModule("pandas")
+_plt = _LazyModule("matplotlib.pyplot")
+
+MANIFEST = '.huji_lab_report.json'
+
+
+_HASHED_GLOBALS = (int, float, complex, str, bytes, _np.generic, _np.ndarray)
+
+
+def _hash_code(digest, code, namespace, seen):
+    """
+    Feeds a code object into a hash: its bytecode, names, constants (nested code objects, like comprehensions,
+    recursively), and the values of the globals it reads that are numbers, strings, arrays or functions.
+    """
+    digest.update(code.co_code)
+    _hash_value(digest, list(code.co_names) + list(code.co_varnames), seen)
+    for const in code.co_consts:
+        if isinstance(const, _types.CodeType):
+            _hash_code(digest, const, namespace, seen)
+        else:
+            digest.update(repr(const).encode('utf-8'))
+    for name in code.co_names:
+        value = namespace.get(name)
+        if isinstance(value, _HASHED_GLOBALS) or isinstance(value, _types.FunctionType):
+            digest.update(name.encode('utf-8'))
+            _hash_value(digest, value, seen)
+
+
+def _hash_value(digest, value, seen=None):
+    """
+    Feeds a spec value (arrays, functions, numbers, strings, containers) into a hash.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(value, _types.FunctionType):
+        if id(value) in seen:  # Recursive functions
+            return
+        seen.add(id(value))
+        _hash_code(digest, value.__code__, value.__globals__, seen)
+        _hash_value(digest, value.__defaults__, seen)
+        _hash_value(digest, [cell.cell_contents for cell in value.__closure__ or ()], seen)
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[')
+        for item in value:
+            _hash_value(digest, item, seen)
+        digest.update(b']')
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            digest.update(str(key).encode('utf-8'))
+            _hash_value(digest, value[key], seen)
+    elif isinstance(value, _np.ndarray) or hasattr(value, '__array__'):
+        array = _np.ascontiguousarray(value)
+        digest.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+        digest.update(array.tobytes() if array.dtype != object else repr(array.tolist()).encode('utf-8'))
+    else:
+        digest.update(repr(value).encode('utf-8'))
+    digest.update(b';')
+
+
+def spec_hash(spec, formats=()):
+    """
+    :param spec: A graph spec (see export_graphs).
+    :param formats: Output formats, part of the hash.
+    :return: A hex digest of the spec's data and options.
+    """
+    digest = _hashlib.sha256()
+    _hash_value(digest, dict(spec, formats=list(formats)))
+    return digest.hexdigest()
+
+
+def _render(shared, index):
+    """
+    Renders one spec with graph_it and saves its figures, in a worker process.
+    :param shared: A tuple (specs, directory, formats).
+    :param index: Index of the spec to render.
+    :return: A summary row (dictionary).
+    """
+    specs, directory, formats = shared
+    if _plt.get_backend().lower() != 'agg':  # Spawned workers start on the default backend
+        _plt.switch_backend('agg')
+    from huji_lab.Graph import graph_it
+    spec = dict(specs[index])
+    name = spec.pop('name')
+    x = spec.pop('x')
+    y = spec.pop('y')
+    spec.setdefault('interactive', False)
+    row = {'name': name, 'files': [], 'error': None}
+    try:
+        res = graph_it(x, y, **spec)
+        for key, suffix in (('main_graph', ''), ('resid_graph', '_residuals')):
+            if key in res:
+                fig = res[key][0]
+                for fmt in formats:
+                    path = _os.path.join(directory, name + suffix + '.' + fmt)
+                    fig.savefig(path, format=fmt, bbox_inches='tight')
+                    row['files'].append(path)
+                _plt.close(fig)
+        params = res.get('params', [])
+        row['params'] = [par.nominal_value for par in params]
+        row['errors'] = [par.std_dev for par in params]
+        row['chi2'] = float(res['chi2']) if 'chi2' in res else None
+        row['p-value'] = float(res['p-value']) if 'p-value' in res else None
+    except Exception as err:
+        row['error'] = "%s: %s" % (type(err).__name__, err)
+        _plt.close('all')
+    return row
+
+
+def export_graphs(specs, directory, formats=('png',), processes=None, force=False):
+    """
+    Renders many graph_it plots (main and residuals) to files across a process pool, on the Agg backend.
+    Specs whose data and options are unchanged since the last export to the same directory are skipped.
+    :param specs: A list of dictionaries, each with 'name' (file name base), 'x', 'y', and any graph_it
+                  keyword arguments. Example: {'name': 'run1', 'x': x, 'y': y, 'graph_type': lambda x,a,b: a*x+b,
+                  'y_error': dy, 'title': 'Run 1'}
+    :param directory: Output directory, created if missing.
+    :param formats: File formats, any of 'png', 'pdf', 'svg'.
+    :param processes: Number of worker processes, None for all cores, 1 for serial.
+    :param force: Render everything, even unchanged specs.
+    :return: A pandas dataframe summary (one row per spec): name, params, errors, chi2, p-value, files, skipped,
+             error. Also written to summary.csv in the directory.
+    """
+    if not _os.path.isdir(directory):
+        _os.makedirs(directory)
+    manifest_path = _os.path.join(directory, MANIFEST)
+    manifest = {}
+    if _os.path.exists(manifest_path):
+        with open(manifest_path) as fh:
+            manifest = _json.load(fh)
+
+    hashes = [spec_hash(spec, formats) for spec in specs]
+    rows = [None] * len(specs)
+    todo = []
+    for i, (spec, digest) in enumerate(zip(specs, hashes)):
+        old = manifest.get(spec['name'])
+        if not force and old is not None and old['hash'] == digest and old['row']['error'] is None and \
+                all(_os.path.exists(path) for path in old['row']['files']):
+            rows[i] = dict(old['row'], skipped=True)
+        else:
+            todo.append(i)
+
+    # Render on Agg, also in this process (serial runs) and in forked workers; the user's backend is restored after.
+    backend = _plt.get_backend()
+    _plt.switch_backend('agg')
+    try:
+        rendered = _parallel_map(_render, todo, processes, shared=(specs, directory, formats))
+    finally:
+        _plt.switch_backend(backend)
+    for i, row in zip(todo, rendered):
+        rows[i] = dict(row, skipped=False)
+        manifest[specs[i]['name']] = {'hash': hashes[i], 'row': row}
+    with open(manifest_path, 'w') as fh:
+        _json.dump(manifest, fh)
+
+    summary = _pd.DataFrame(rows, columns=['name', 'params', 'errors', 'chi2', 'p-value', 'files', 'skipped',
+                                           'error'])
+    summary.to_csv(_os.path.join(directory, 'summary.csv'), index=False)
+    return summary
@@ -1,10 +1,20 @@
-import seaborn as _sns
-from . import Errors
-from . import Graph
-from . import DataProc
-from . import Generators
-from . import Display
-from IPython.display import display
-
-_sns.set(font_scale=2)
-_sns.set_style("whitegrid")
\ No newline at end of file
+import importlib as _importlib
+
+# Submodules are imported on first access (huji_lab.Graph etc.), so "import huji_lab" stays fast.
+_submodules = ('Errors', 'Graph', 'DataProc', 'Generators', 'Display', 'Fitting', 'Profiling', 'Cache', 'Reports', 'Loaders', 'Bootstrap')
+
+__all__ = list(_submodules) + ['display']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return _importlib.import_module('.' + name, __name__)
+    if name == 'display':
+        from IPython.display import display
+        globals()['display'] = display
+        return display
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,23 @@
+import importlib as _importlib
+
+
+class LazyModule(object):
+    """
+    A stand-in for a module, which is only imported on first attribute access.
+    Keeps "import huji_lab" cheap, heavy dependencies (pandas, scipy, seaborn...) load only when used.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: Full dotted name of the module. Example: "scipy.optimize"
+        """
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        module = _importlib.import_module(self._lazy_name)
+        # Copy the module namespace, so later lookups don't go through __getattr__ again.
+        self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._lazy_name
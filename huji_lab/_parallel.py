@@ -0,0 +1,73 @@
+import multiprocessing as _mp
+import os as _os
+import pickle as _pickle
+import sys as _sys
+
+# Set in each worker process by _init_worker, holds the (possibly unpicklable) shared object, e.g. a lambda.
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _call(task):
+    func, item = task
+    return func(_shared, item)
+
+
+def _context(shared):
+    """
+    Picks a multiprocessing context able to hand "shared" to the workers.
+    Lambdas can't be pickled, so on Linux prefer "fork" (workers inherit it). Elsewhere fork is unsafe (macOS system
+    frameworks, GUI backends), so use the default start method if "shared" pickles. Returns None when no context fits.
+    """
+    if _sys.platform.startswith('linux'):
+        return _mp.get_context('fork')
+    try:
+        _pickle.dumps(shared)
+    except Exception:
+        return None
+    return _mp.get_context()
+
+
+def split_chunks(items, n_chunks):
+    """
+    Splits a list into n_chunks contiguous, nearly equal slices (empty slices are dropped).
+    :param items: A list.
+    :param n_chunks: Number of slices.
+    :return: A list of lists.
+    """
+    n_chunks = max(1, min(n_chunks, len(items)))
+    bounds = [len(items) * i // n_chunks for i in range(n_chunks + 1)]
+    return [items[bounds[i]:bounds[i + 1]] for i in range(n_chunks) if bounds[i] < bounds[i + 1]]
+
+
+def cpu_count(processes=None):
+    """
+    :param processes: Requested number of processes, None for all cores.
+    :return: Number of worker processes to use.
+    """
+    if processes is None:
+        return _os.cpu_count() or 1
+    return max(1, int(processes))
+
+
+def parallel_map(func, items, processes=None, shared=None):
+    """
+    Maps func(shared, item) over items across a process pool, preserving order.
+    Falls back to a serial loop for a single process/item, or when shared can't reach the workers.
+    :param func: A module level function taking (shared, item).
+    :param items: A list of picklable items.
+    :param processes: Number of worker processes, None for all cores.
+    :param shared: An object passed to every call, sent once per worker (may be a lambda on fork platforms).
+    :return: A list of results.
+    """
+    items = list(items)
+    processes = min(cpu_count(processes), len(items))
+    context = _context(shared) if processes > 1 else None
+    if context is None:
+        return [func(shared, item) for item in items]
+    with context.Pool(processes, initializer=_init_worker, initargs=(shared,)) as pool:
+        return pool.map(_call, [(func, item) for item in items], chunksize=1)
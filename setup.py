@@ -13,7 +13,7 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/stormage2/huji_lab/",
     packages=setuptools.find_packages(),
-	install_requires=["numpy","scipy","pandas","matplotlib","sympy","seaborn","uncertainties","mplcursors","wolframalpha","analytic_wfm"],
+	install_requires=["numpy","scipy","pandas","matplotlib","sympy","seaborn","uncertainties","mplcursors","wolframalpha","httpx","xmltodict"],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",